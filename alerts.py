@@ -0,0 +1,218 @@
+import math
+import threading
+from collections import deque
+
+from clearml_api import PLOTTED_SECTIONS
+
+ALERT_USAGE = (
+    "Usage:\n"
+    "/alert <section>/<metric> above <value>\n"
+    "/alert <section>/<metric> below <value>\n"
+    "/alert <section>/<metric> plateau <iterations> <min change>\n"
+    "/alert <section>/<metric> diverge <factor>\n"
+    "Sections: " + ", ".join(PLOTTED_SECTIONS) + ". Example: /alert val/loss plateau 500 0.001"
+)
+
+
+class AlertRule:
+    __slots__ = ("rule_id", "section", "metric", "kind", "threshold", "window")
+
+    def __init__(self, rule_id, section, metric, kind, threshold, window):
+        self.rule_id = rule_id
+        self.section = section
+        self.metric = metric
+        self.kind = kind
+        self.threshold = threshold
+        self.window = window
+
+    @classmethod
+    def from_row(cls, row):
+        rule_id, _, section, metric, kind, threshold, window = row
+        return cls(rule_id, section, metric, kind, threshold, window)
+
+    def describe(self):
+        target = f'{self.section}/{self.metric}'
+        if self.kind == "plateau":
+            return f'{target} changed by less than {self.threshold:g} in {self.window} iterations'
+        if self.kind == "diverge":
+            return f'{target} rose above {self.threshold:g}x its best value'
+        return f'{target} {self.kind} {self.threshold:g}'
+
+
+def parse_rule(text):
+    # "/alert val/loss plateau 500 0.001" -> ("val", "loss", "plateau", 0.001, 500)
+    tokens = text.split()[1:]
+    if len(tokens) < 3 or '/' not in tokens[0]:
+        raise ValueError(ALERT_USAGE)
+    section, metric = tokens[0].split('/', 1)
+    kind, args = tokens[1].lower(), tokens[2:]
+    if section not in PLOTTED_SECTIONS or not metric:
+        raise ValueError(ALERT_USAGE)
+    try:
+        if kind in ("above", "below") and len(args) == 1:
+            return section, metric, kind, float(args[0]), None
+        if kind == "plateau" and len(args) == 2 and int(args[0]) > 0:
+            return section, metric, kind, float(args[1]), int(args[0])
+        if kind == "diverge" and len(args) == 1 and float(args[0]) > 1:
+            return section, metric, kind, float(args[0]), None
+    except ValueError:
+        pass
+    raise ValueError(ALERT_USAGE)
+
+
+class RuleState:
+    # Rolling state of one rule on one experiment; every update is O(1), the
+    # plateau window amortized O(1)
+    __slots__ = ("firing", "best", "points", "minimums", "maximums")
+
+    def __init__(self):
+        self.firing = False
+        self.best = None
+        # (iteration, value) within the plateau window; the first point is the
+        # value in effect at the window start
+        self.points = deque()
+        # Monotonic queues of the same points for the window's min and max
+        self.minimums = deque()
+        self.maximums = deque()
+
+    def push(self, iteration, value):
+        self.points.append((iteration, value))
+        while self.minimums and self.minimums[-1][1] >= value:
+            self.minimums.pop()
+        self.minimums.append((iteration, value))
+        while self.maximums and self.maximums[-1][1] <= value:
+            self.maximums.pop()
+        self.maximums.append((iteration, value))
+
+    def window_range(self, window_start):
+        points = self.points
+        while len(points) > 1 and points[1][0] <= window_start:
+            points.popleft()
+        if not points or points[0][0] > window_start:
+            # History does not cover the whole window yet
+            return None
+        first_iteration = points[0][0]
+        while self.minimums[0][0] < first_iteration:
+            self.minimums.popleft()
+        while self.maximums[0][0] < first_iteration:
+            self.maximums.popleft()
+        return self.maximums[0][1] - self.minimums[0][1]
+
+
+class AlertEngine:
+    # Evaluates users' alert rules on the metric points of each poll. Rules are
+    # read from the database once per user; points are never read back
+    def __init__(self, database):
+        self.database = database
+        # chat_id -> {(section, metric): [AlertRule]}
+        self.rules = {}
+        # chat_id -> {(experiment_id, rule_id): RuleState}
+        self.states = {}
+        self.lock = threading.Lock()
+
+    def _get_rules(self, chat_id):
+        rules = self.rules.get(chat_id)
+        if rules is None:
+            rules = {}
+            for row in self.database.get_alert_rules(chat_id):
+                rule = AlertRule.from_row(row)
+                rules.setdefault((rule.section, rule.metric), []).append(rule)
+            self.rules[chat_id] = rules
+        return rules
+
+    def add_rule(self, chat_id, section, metric, kind, threshold, window):
+        rule_id = self.database.add_alert_rule(chat_id, section, metric, kind, threshold, window)
+        rule = AlertRule(rule_id, section, metric, kind, threshold, window)
+        with self.lock:
+            # Rules not cached yet are loaded later, new one included
+            rules = self.rules.get(chat_id)
+            if rules is not None:
+                rules.setdefault((section, metric), []).append(rule)
+        return rule
+
+    def delete_rule(self, chat_id, rule_id):
+        if not self.database.delete_alert_rule(chat_id, rule_id):
+            return False
+        with self.lock:
+            for rules in self._get_rules(chat_id).values():
+                rules[:] = [rule for rule in rules if rule.rule_id != rule_id]
+            states = self.states.get(chat_id, {})
+            for key in [key for key in states if key[1] == rule_id]:
+                states.pop(key)
+        return True
+
+    def list_rules(self, chat_id):
+        with self.lock:
+            rules = [rule for rules in self._get_rules(chat_id).values() for rule in rules]
+        return sorted(rules, key=lambda rule: rule.rule_id)
+
+    def forget_user(self, chat_id):
+        with self.lock:
+            self.rules.pop(chat_id, None)
+            self.states.pop(chat_id, None)
+
+    def retain_experiments(self, chat_id, experiment_ids):
+        # Drops the rolling state of experiments that are no longer running
+        with self.lock:
+            states = self.states.get(chat_id)
+            if states:
+                for key in [key for key in states if key[0] not in experiment_ids]:
+                    states.pop(key)
+
+    def process(self, chat_id, experiment_id, experiment_name, iteration, points):
+        # points are (section, metric, iteration, value); returns (rule, message)
+        # for rules that started firing, a rule fires again only after it cleared
+        fired = []
+        with self.lock:
+            rules = self._get_rules(chat_id)
+            if not rules:
+                return fired
+            states = self.states.setdefault(chat_id, {})
+            for section, metric, point_iteration, value in points:
+                for rule in rules.get((section, metric), ()):
+                    state = states.get((experiment_id, rule.rule_id))
+                    if state is None:
+                        state = states[experiment_id, rule.rule_id] = RuleState()
+                    if rule.kind == "plateau":
+                        state.push(point_iteration, value)
+                        continue
+                    firing = self._check(rule, state, value)
+                    self._update(state, firing, rule, experiment_id, experiment_name, point_iteration, value, fired)
+
+            # A plateau is about iterations passing without change, so it is
+            # checked whether or not its metric reported this time
+            for rules_of_metric in rules.values():
+                for rule in rules_of_metric:
+                    if rule.kind != "plateau":
+                        continue
+                    state = states.get((experiment_id, rule.rule_id))
+                    if state is None:
+                        continue
+                    value_range = state.window_range(iteration - rule.window)
+                    firing = value_range is not None and value_range < rule.threshold
+                    self._update(state, firing, rule, experiment_id, experiment_name, iteration,
+                                 state.points[-1][1], fired)
+        return fired
+
+    @staticmethod
+    def _check(rule, state, value):
+        if rule.kind == "above":
+            return value > rule.threshold
+        if rule.kind == "below":
+            return value <= rule.threshold
+        # diverge: meant for metrics that should go down, like a loss
+        if not math.isfinite(value):
+            return True
+        best = state.best
+        state.best = value if best is None else min(best, value)
+        return best is not None and best > 0 and value > best * rule.threshold
+
+    @staticmethod
+    def _update(state, firing, rule, experiment_id, experiment_name, iteration, value, fired):
+        if firing and not state.firing:
+            fired.append((rule, f'Alert #{rule.rule_id}: {rule.describe()}\n'
+                                f'Name: {experiment_name}\n'
+                                f'  - Id: {experiment_id}\n'
+                                f'  - Epoch: {iteration}\n'
+                                f'  - Value: {value:g}'))
+        state.firing = firing
@@ -0,0 +1,59 @@
+import argparse
+import math
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from alerts import AlertEngine
+from database import Database
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Alert rule evaluation throughput')
+    parser.add_argument('--experiments', type=int, default=20)
+    parser.add_argument('--metrics', type=int, default=50, help='metrics per experiment, each with 4 rules')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--window', type=int, default=50, help='plateau window in iterations')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        database = Database(os.path.join(tmp_dir, 'bench_alerts.db'))
+        engine = AlertEngine(database)
+        chat_id = 1
+        for m in range(args.metrics):
+            metric = f'metric_{m:02d}'
+            engine.add_rule(chat_id, "val", metric, "above", 0.95, None)
+            engine.add_rule(chat_id, "val", metric, "below", 0.05, None)
+            engine.add_rule(chat_id, "val", metric, "plateau", 0.01, args.window)
+            engine.add_rule(chat_id, "val", metric, "diverge", 3.0, None)
+        # The first rule is added before the chat's rules are cached and must not be listed twice
+        rule_count = len(engine.list_rules(chat_id))
+        if rule_count != 4 * args.metrics:
+            print(f'Expected {4 * args.metrics} rules, listed {rule_count}')
+
+        points = 0
+        alerts = 0
+        start = time.perf_counter()
+        for iteration in range(args.iterations):
+            for e in range(args.experiments):
+                # Half of the metrics flatten out after half of the run so plateaus fire
+                poll = [("val", f'metric_{m:02d}', iteration,
+                         0.5 + 0.45 * math.sin((min(iteration, args.iterations // 2) if m % 2 else iteration) + m + e))
+                        for m in range(args.metrics)]
+                alerts += len(engine.process(chat_id, f'exp_{e}', f'experiment {e}', iteration + 1, poll))
+                points += len(poll)
+        elapsed = time.perf_counter() - start
+        database.close_connection()
+
+    print(f'{args.experiments} experiments x {args.metrics} metrics x {args.iterations} iterations, '
+          f'{4 * args.metrics} rules')
+    print(f'Points:     {points} in {elapsed:.3f}s ({points / elapsed:,.0f} points/s, '
+          f'{4 * points / elapsed:,.0f} rule evaluations/s)')
+    print(f'Alerts:     {alerts}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from database import Database
+
+
+class BaselineDatabase(Database):
+    # SQLite defaults as the bot ran before: rollback journal and a full sync on every commit
+    def set_pragmas(self):
+        pass
+
+
+def make_points(count):
+    metric_names = ["loss", "accuracy", "f1", "lr"]
+    return [
+        (1, "experiment", "train" if i % 2 else "val",
+         metric_names[i % len(metric_names)], i, i / count)
+        for i in range(count)
+    ]
+
+
+def bench_per_row(db, points):
+    start = time.perf_counter()
+    for point in points:
+        db.insert_metric(*point)
+    return time.perf_counter() - start
+
+
+def bench_batched(db, points):
+    start = time.perf_counter()
+    db.insert_metrics(points)
+    return time.perf_counter() - start
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1_000, 10_000, 100_000]
+    # baseline: per-row commits with default pragmas; per-row: the same with WAL and
+    # synchronous=NORMAL, so the pragmas' gain and batching's gain show separately
+    print(f'{"points":>8} {"baseline, s":>12} {"per-row, s":>12} {"batched, s":>12} {"pragmas":>8} '
+          f'{"batching":>9} {"total":>8}')
+    for size in sizes:
+        points = make_points(size)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            baseline_db = BaselineDatabase(os.path.join(tmp_dir, 'baseline.db'))
+            baseline_time = bench_per_row(baseline_db, points)
+            baseline_db.close_connection()
+
+            per_row_db = Database(os.path.join(tmp_dir, 'per_row.db'))
+            per_row_time = bench_per_row(per_row_db, points)
+            per_row_db.close_connection()
+
+            batched_db = Database(os.path.join(tmp_dir, 'batched.db'))
+            batched_time = bench_batched(batched_db, points)
+            batched_db.close_connection()
+
+        print(f'{size:>8} {baseline_time:>12.3f} {per_row_time:>12.3f} {batched_time:>12.3f} '
+              f'{baseline_time / per_row_time:>7.1f}x {per_row_time / batched_time:>8.1f}x '
+              f'{baseline_time / batched_time:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
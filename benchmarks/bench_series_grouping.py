@@ -0,0 +1,72 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from metric_store import SectionSeries
+
+
+def make_points(metrics, iterations):
+    # Database order: by iteration, all metrics of an iteration together
+    return [(f'metric_{m:02d}', i, (i * 7 + m) % 100 / 100) for i in range(iterations) for m in range(metrics)]
+
+
+def legacy_group(rows):
+    # The per-metric mask grouping that _get_plot used before, on full metrics rows
+    metric_names = [metric[3] for metric in rows]
+    iterations = [metric[4] for metric in rows]
+    values = [metric[5] for metric in rows]
+
+    series = []
+    for metric_name in set(metric_names):
+        mask = [name == metric_name for name in metric_names]
+        metric_iterations = [iterations[j] for j, m in enumerate(mask) if m]
+        metric_values = [values[j] for j, m in enumerate(mask) if m]
+        series.append((metric_name, metric_iterations, metric_values))
+    return series
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Grouping metric rows into per-metric series')
+    parser.add_argument('--metrics', type=int, default=50)
+    parser.add_argument('--points', type=int, default=100_000, help='points per metric')
+    parser.add_argument('--legacy-limit', type=int, default=1_000_000,
+                        help='skip the legacy grouping above this many rows, it is quadratic in practice')
+    args = parser.parse_args()
+
+    points = make_points(args.metrics, args.points)
+    print(f'{args.metrics} metrics x {args.points} points = {len(points)} rows')
+
+    start = time.perf_counter()
+    section_series = SectionSeries()
+    section_series.merge(points)
+    load_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    series = section_series.series()
+    group_time = time.perf_counter() - start
+    assert len(series) == args.metrics
+
+    tail = [(name, args.points, value) for name, _, value in points[-args.metrics:]]
+    start = time.perf_counter()
+    section_series.merge(tail)
+    section_series.series()
+    incremental_time = time.perf_counter() - start
+
+    print(f'Columnar load:              {load_time:.3f}s')
+    print(f'Columnar group:             {group_time:.3f}s')
+    print(f'Next iteration (merge+group): {incremental_time:.3f}s')
+
+    if len(points) <= args.legacy_limit:
+        rows = [(1, 'experiment', 'train', name, iteration, value) for name, iteration, value in points]
+        start = time.perf_counter()
+        legacy_group(rows)
+        print(f'Legacy mask grouping:       {time.perf_counter() - start:.3f}s')
+    else:
+        print(f'Legacy mask grouping:       skipped, {len(points)} rows > --legacy-limit')
+
+
+if __name__ == '__main__':
+    main()
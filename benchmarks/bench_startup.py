@@ -0,0 +1,72 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO_DIR)
+
+from database import Database
+
+# Runs in a fresh interpreter so imports are measured cold. The first poll is
+# intercepted right before it would reach the ClearML server.
+CHILD = '''
+import json, resource, sys, threading, time
+start = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+
+from bot import ClearMLBot
+from database import Database
+imported = time.perf_counter()
+
+database = Database(sys.argv[2])
+bot = ClearMLBot("0:benchmark", database)
+bot.restore_subscriptions()
+ready = time.perf_counter()
+
+first_poll = threading.Event()
+bot.update_engine.update_user = lambda chat_id: first_poll.set()
+while not first_poll.is_set():
+    bot.send_due_updates()
+    first_poll.wait(0.01)
+polled = time.perf_counter()
+
+print(json.dumps({
+    "import_s": imported - start,
+    "ready_s": ready - start,
+    "first_poll_s": polled - start,
+    "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "subscriptions": len(bot.user_sessions),
+    "heavy_modules": sorted(m for m in ("clearml", "matplotlib", "numpy") if m in sys.modules),
+}))
+'''
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'startup.db')
+        database = Database(db_path)
+        for user_id in range(users):
+            database.insert_user(user_id, f'user_{user_id}', 'https://api.clear.ml', 'key', 'secret')
+            database.add_subscription(user_id)
+        database.close_connection()
+
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', CHILD, REPO_DIR, db_path],
+                                capture_output=True, text=True, check=True).stdout
+        total = time.perf_counter() - start
+
+    result = json.loads(output)
+    print(f'Subscriptions restored: {result["subscriptions"]}')
+    print(f'Imports:                {result["import_s"]:.3f}s')
+    print(f'Bot ready:              {result["ready_s"]:.3f}s')
+    print(f'Time to first poll:     {result["first_poll_s"]:.3f}s (process total {total:.3f}s)')
+    print(f'Max RSS:                {result["rss_mb"]:.1f} MB')
+    print(f'Heavy modules loaded:   {", ".join(result["heavy_modules"]) or "none"}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+import base64
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeServer:
+    def __init__(self, handler_class, latency=0.0, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.httpd.server_address[1]}'
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+
+    def count(self, endpoint):
+        with self.lock:
+            self.calls[endpoint] += 1
+
+    def take_calls(self):
+        with self.lock:
+            calls, self.calls = self.calls, Counter()
+        return calls
+
+    def simulate_network(self):
+        if self.latency:
+            time.sleep(random.uniform(0.5, 1.5) * self.latency)
+        return random.random() < self.error_rate
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def send_json(self, payload, status=200, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+
+class ClearMLState:
+    # Tasks of every workspace advance together; advanced_at lets the Telegram
+    # side measure how long an iteration took to reach the user
+    def __init__(self, workspaces, experiments, metrics):
+        self.workspaces = workspaces
+        self.experiments = experiments
+        self.metrics = metrics
+        self.iteration = 1
+        self.started = time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime())
+        self.advanced_at = {1: time.monotonic()}
+        self.lock = threading.Lock()
+
+    def advance(self):
+        with self.lock:
+            self.iteration += 1
+            self.advanced_at[self.iteration] = time.monotonic()
+
+    def last_metrics(self, iteration):
+        last_metrics = {}
+        for k in range(self.metrics):
+            section = 'train' if k % 2 == 0 else 'val'
+            value = (k + iteration) % 100 / 100
+            if k == self.metrics - 1:
+                # A saturated metric keeps its value and still gets a point every iteration
+                value = 1.0
+            last_metrics.setdefault(f'{section}_hash', {})[f'variant_{k}'] = {
+                'metric': section,
+                'variant': f'metric_{k}',
+                'value': value,
+                'min_value': 0.0,
+                'max_value': value,
+                'min_value_iteration': 0,
+                'max_value_iteration': iteration,
+            }
+        return last_metrics
+
+    def running_tasks(self, workspace):
+        with self.lock:
+            iteration = self.iteration
+        last_metrics = self.last_metrics(iteration)
+        return [{
+            'id': f'{workspace}-exp-{m}',
+            'name': f'experiment {m}',
+            'last_iteration': iteration,
+            'started': self.started,
+            'last_metrics': last_metrics,
+        } for m in range(self.experiments)]
+
+
+class ClearMLHandler(FakeHandler):
+    def handle_request(self):
+        action = urlparse(self.path).path.strip('/').split('/')[-1]
+        self.read_body()
+        self.fake.count(action)
+        meta = {'id': '0', 'trx': '0', 'result_code': 200, 'result_subcode': 0, 'result_msg': 'OK',
+                'endpoint': {'name': action, 'requested_version': '2.23', 'actual_version': '2.23'}}
+
+        if self.fake.simulate_network():
+            meta.update(result_code=500, result_msg='Simulated server error')
+            self.send_json({'meta': meta, 'data': {}}, status=500)
+            return
+
+        workspace = self.workspace()
+        if action == 'auth.login':
+            data = {'token': self.make_token(workspace)}
+        elif action == 'users.get_current_user':
+            data = {'user': {'id': workspace, 'company': {'id': workspace}}}
+        elif action == 'tasks.get_all':
+            data = {'tasks': self.fake.state.running_tasks(workspace)}
+        else:
+            data = {}
+        self.send_json({'meta': meta, 'data': data}, headers={'X-Clearml-Server-Version': '1.9.0'})
+
+    @staticmethod
+    def make_token(workspace):
+        # The ClearML client reads the API version and expiry from the token
+        # payload without checking the signature
+        def encode(part):
+            return base64.urlsafe_b64encode(json.dumps(part).encode()).rstrip(b'=').decode()
+        payload = {'exp': int(time.time()) + 86400, 'api_version': '2.23', 'workspace': workspace}
+        return f'{encode({"alg": "HS256", "typ": "JWT"})}.{encode(payload)}.c2lnbmF0dXJl'
+
+    def workspace(self):
+        # Workspaces are encoded in the access key as "<workspace>.<user>"
+        authorization = self.headers.get('Authorization', '')
+        if authorization.startswith('Basic '):
+            access_key = base64.b64decode(authorization[6:]).decode().split(':')[0]
+            return access_key.split('.')[0]
+        if authorization.startswith('Bearer '):
+            payload = authorization[7:].split('.')[1]
+            payload += '=' * (-len(payload) % 4)
+            return json.loads(base64.urlsafe_b64decode(payload))['workspace']
+        return 'anonymous'
+
+
+class FakeClearMLServer(FakeServer):
+    def __init__(self, state, latency=0.0, error_rate=0.0):
+        super().__init__(ClearMLHandler, latency, error_rate)
+        self.state = state
+
+
+class TelegramHandler(FakeHandler):
+    EPOCH_PATTERN = re.compile(r'Epoch: (\d+)')
+
+    def handle_request(self):
+        parsed = urlparse(self.path)
+        method = parsed.path.rsplit('/', 1)[-1]
+        params = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+        body = self.read_body()
+        self.fake.count_bytes(len(body))
+        if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+            params.update({key: values[0] for key, values in parse_qs(body.decode()).items()})
+        self.fake.count(method)
+
+        if self.fake.simulate_network():
+            self.send_json({'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                            'parameters': {'retry_after': 1}}, status=429)
+            return
+
+        chat_id = int(params.get('chat_id', 0))
+        self.fake.count_chat(method, chat_id)
+        # Dashboards carry the experiment text as a photo caption
+        text = params.get('text') or params.get('caption') or json.loads(params.get('media', '{}')).get('caption', '')
+        match = self.EPOCH_PATTERN.search(text)
+        if match:
+            self.fake.record_delivery(int(match.group(1)))
+
+        message_id = int(params.get('message_id') or self.fake.next_message_id())
+        self.send_json({'ok': True, 'result': {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': text,
+        }})
+
+
+class FakeTelegramServer(FakeServer):
+    def __init__(self, state, latency=0.0, error_rate=0.0):
+        super().__init__(TelegramHandler, latency, error_rate)
+        self.state = state
+        self.message_ids = 0
+        self.delivery_latencies = []
+        self.chat_calls = Counter()
+        self.received_bytes = 0
+
+    def next_message_id(self):
+        with self.lock:
+            self.message_ids += 1
+            return self.message_ids
+
+    def count_bytes(self, size):
+        with self.lock:
+            self.received_bytes += size
+
+    def count_chat(self, method, chat_id):
+        with self.lock:
+            self.chat_calls[method, chat_id] += 1
+
+    def take_chat_calls(self):
+        with self.lock:
+            chat_calls, self.chat_calls = self.chat_calls, Counter()
+        return chat_calls
+
+    def record_delivery(self, iteration):
+        advanced_at = self.state.advanced_at.get(iteration)
+        if advanced_at is not None:
+            with self.lock:
+                self.delivery_latencies.append(time.monotonic() - advanced_at)
@@ -0,0 +1,118 @@
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import telebot
+
+from bot import ClearMLBot
+from clearml_api import DELIVERY_MODES, ClearML_API_Wrapped
+from database import Database
+from fake_servers import ClearMLState, FakeClearMLServer, FakeTelegramServer
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Offline load test against stand-in ClearML and Telegram servers')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--users-per-workspace', type=int, default=1)
+    parser.add_argument('--experiments', type=int, default=3, help='running experiments per workspace')
+    parser.add_argument('--metrics', type=int, default=8, help='metrics per experiment')
+    parser.add_argument('--cycles', type=int, default=10)
+    parser.add_argument('--clearml-latency', type=float, default=0.05)
+    parser.add_argument('--clearml-error-rate', type=float, default=0.0)
+    parser.add_argument('--telegram-latency', type=float, default=0.05)
+    parser.add_argument('--telegram-error-rate', type=float, default=0.0)
+    parser.add_argument('--update-workers', type=int, default=8)
+    parser.add_argument('--mode', choices=DELIVERY_MODES, default=DELIVERY_MODES[0], help='delivery mode of every user')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    workspaces = (args.users + args.users_per_workspace - 1) // args.users_per_workspace
+    state = ClearMLState(workspaces, args.experiments, args.metrics)
+    clearml_server = FakeClearMLServer(state, args.clearml_latency, args.clearml_error_rate).start()
+    telegram_server = FakeTelegramServer(state, args.telegram_latency, args.telegram_error_rate).start()
+    telebot.apihelper.API_URL = telegram_server.url + '/bot{0}/{1}'
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        database = Database(os.path.join(tmp_dir, 'load_test.db'))
+        for user_id in range(args.users):
+            workspace = f'ws{user_id // args.users_per_workspace}'
+            database.insert_user(user_id, f'user_{user_id}', clearml_server.url,
+                                 f'{workspace}.user{user_id}', 'secret')
+            database.add_subscription(user_id)
+
+        bot = ClearMLBot('0:load-test', database, {
+            "UPDATE_WORKERS": args.update_workers,
+            # Delivery is what is being measured, so Telegram's limits are not simulated twice
+            "TG_GLOBAL_RATE": 10_000,
+            "TG_CHAT_RATE": 10_000,
+            "DELIVERY_MODE": args.mode,
+        })
+        bot.restore_subscriptions()
+
+        print(f'{args.users} users, {workspaces} workspaces, {args.experiments} experiments, '
+              f'{args.metrics} metrics')
+        print(f'{"cycle":>5} {"wall, s":>8} {"clearml":>8} {"telegram":>9} {"db writes":>10}')
+        cycle_times = []
+        total_calls = Counter()
+        for cycle in range(args.cycles):
+            state.advance()
+            db_changes = database.conn.total_changes
+            start = time.perf_counter()
+            bot.send_updates_to_users()
+            cycle_time = time.perf_counter() - start
+            bot.delivery_queue.wait_idle(timeout=60)
+            cycle_times.append(cycle_time)
+
+            clearml_calls = clearml_server.take_calls()
+            telegram_calls = telegram_server.take_calls()
+            total_calls.update(clearml_calls)
+            total_calls.update(telegram_calls)
+            print(f'{cycle:>5} {cycle_time:>8.3f} {sum(clearml_calls.values()):>8} '
+                  f'{sum(telegram_calls.values()):>9} {database.conn.total_changes - db_changes:>10}')
+
+        latencies = telegram_server.delivery_latencies
+        print()
+        print(f'Cycle wall time:   p50 {percentile(cycle_times, 0.5):.3f}s  p99 {percentile(cycle_times, 0.99):.3f}s  '
+              f'mean {statistics.mean(cycle_times):.3f}s')
+        print(f'Delivery latency:  p50 {percentile(latencies, 0.5):.3f}s  p99 {percentile(latencies, 0.99):.3f}s  '
+              f'({len(latencies)} text updates)')
+        print(f'Uploaded to Telegram: {telegram_server.received_bytes / 1024:.0f} KiB')
+        print('API calls:         ' + ', '.join(f'{name} {count}' for name, count in total_calls.most_common()))
+
+        # Only changed values are stored; every plotted metric, including ones
+        # that keep their value, still reaches the last iteration
+        missing = 0
+        user_api_client = bot.user_sessions[0]
+        for section in ("train", "val"):
+            section_series = user_api_client._get_section_metrics(0, 'ws0-exp-0', section)
+            color_indices = {metric_name: 0 for metric_name in section_series.metric_names()}
+            for metric_name, _, iterations, _ in ClearML_API_Wrapped._get_series(
+                    section_series, color_indices, last_iteration=state.iteration):
+                missing += iterations[-1] != ClearML_API_Wrapped._metric_iteration(metric_name, state.iteration)
+        if missing:
+            print(f'Plotted metrics not reaching the last iteration: {missing}')
+
+        bot.renderer.shutdown()
+        database.close_connection()
+
+    clearml_server.stop()
+    telegram_server.stop()
+
+
+if __name__ == '__main__':
+    main()
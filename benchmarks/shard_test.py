@@ -0,0 +1,89 @@
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from database import Database
+from fake_servers import ClearMLState, FakeClearMLServer, FakeTelegramServer
+from sharding import ShardManager
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Sharded mode against stand-in ClearML and Telegram servers: '
+                                                 'checks that every chat is served by exactly one worker, '
+                                                 'also after a worker is killed and restarted')
+    parser.add_argument('--users', type=int, default=12)
+    parser.add_argument('--workers', type=int, default=3)
+    parser.add_argument('--experiments', type=int, default=2, help='running experiments per user')
+    parser.add_argument('--phase', type=float, default=20, help='seconds per phase')
+    return parser.parse_args()
+
+
+def run_phase(name, state, telegram_server, args):
+    deadline = time.monotonic() + args.phase
+    while time.monotonic() < deadline:
+        state.advance()
+        time.sleep(1)
+    chat_calls = telegram_server.take_chat_calls()
+
+    served = {chat_id for (method, chat_id) in chat_calls if method in ('sendMessage', 'editMessageText')}
+    # Each experiment gets one text message; more means two workers served the chat
+    duplicated = [chat_id for chat_id in range(args.users)
+                  if chat_calls['sendMessage', chat_id] > args.experiments]
+    missing = [chat_id for chat_id in range(args.users) if chat_id not in served]
+    print(f'{name:<22} served {len(served):>4}/{args.users}  duplicated first messages {len(duplicated):>4}  '
+          f'missing {missing[:10]}')
+    return not duplicated and not missing
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    state = ClearMLState(args.users, args.experiments, metrics=4)
+    clearml_server = FakeClearMLServer(state).start()
+    telegram_server = FakeTelegramServer(state).start()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_name = os.path.join(tmp_dir, 'shard_test.db')
+        database = Database(db_name)
+        for user_id in range(args.users):
+            database.insert_user(user_id, f'user_{user_id}', clearml_server.url, f'ws{user_id}.user{user_id}',
+                                 'secret')
+            database.add_subscription(user_id)
+        database.close_connection()
+
+        shards = ShardManager({
+            "TG_TOKEN": "0:shard-test",
+            "TELEGRAM_API_URL": telegram_server.url,
+            "UPDATE_INTERVAL": 1,
+            "MAX_UPDATE_INTERVAL": 2,
+            "FLUSH_INTERVAL": 1,
+            "TG_GLOBAL_RATE": 10_000,
+            "TG_CHAT_RATE": 10_000,
+            "RENDER_WORKERS": 1,
+        }, db_name, workers=args.workers, restart_delay=args.phase).start()
+
+        owners = [shards.ring.node_for(chat_id) for chat_id in range(args.users)]
+        print('Chats per worker: ' + ', '.join(f'{index}: {owners.count(index)}' for index in range(args.workers)))
+
+        # Workers import ClearML and log in on their first poll, and first sightings send nothing
+        run_phase('warm-up', state, telegram_server, args)
+        ok = run_phase('all workers', state, telegram_server, args)
+        busiest = max(range(args.workers), key=owners.count)
+        shards.processes[busiest].kill()
+        ok &= run_phase(f'worker {busiest} killed', state, telegram_server, args)
+        run_phase(f'worker {busiest} restarting', state, telegram_server, args)
+        ok &= run_phase(f'worker {busiest} restarted', state, telegram_server, args)
+        shards.stop()
+
+    clearml_server.stop()
+    telegram_server.stop()
+    print('OK' if ok else 'FAILED')
+
+
+if __name__ == '__main__':
+    main()
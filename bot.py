@@ -1,18 +1,90 @@
 import logging
 import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import telebot
 
-from clearml_api import ClearML_API_Wrapped
+from alerts import ALERT_USAGE, AlertEngine, parse_rule
+from clearml_api import DELIVERY_MODES, ClearML_API_Wrapped
+from delivery import DeliveryQueue
+from instrumentation import stats
+from lifecycle import LifecycleManager
+from poller import SharedPoller
+from rendering import PlotRenderer
+from scheduler import AdaptiveScheduler
+from session_pool import SessionPool
+from update_engine import UpdateEngine
+from webhook import start_webhook_server
+
+EXPERIMENTS_PAGE_SIZE = 10
+MESSAGE_CHARS = 4096
+# Telegram rejects messages longer than MESSAGE_CHARS; the rest is left for the page header
+EXPERIMENTS_PAGE_CHARS = 3900
 
 
 class ClearMLBot:
-    def __init__(self, bot_token, database):
+    def __init__(self, bot_token, database, config=None):
+        config = config or {}
         self.database = database
-        self.bot = telebot.TeleBot(bot_token)
+        if config.get("TELEGRAM_API_URL"):
+            telebot.apihelper.API_URL = config["TELEGRAM_API_URL"].rstrip('/') + '/bot{0}/{1}'
+        # Set in the worker processes of the sharded mode
+        self.shard_index = config.get("SHARD_INDEX")
+        # In webhook and sharded modes handlers run on a chat dispatcher instead
+        # of telebot's own worker threads
+        self.bot = telebot.TeleBot(bot_token, threaded=not (config.get("WEBHOOK_URL") or
+                                                            self.shard_index is not None))
 
         self.subscribed_users = set()
         self.user_sessions = {}
+        self.poller = SharedPoller()
+        self.session_pool = SessionPool(
+            max_requests_per_host=config.get("CLEARML_HOST_CONCURRENCY", 4),
+            timeout=config.get("CLEARML_TIMEOUT", 30)
+        )
+        self.snapshot_ttl = config.get("EXPERIMENTS_SNAPSHOT_TTL", 15)
+        self.scheduler = AdaptiveScheduler(
+            min_interval=config.get("UPDATE_INTERVAL", 5),
+            max_interval=config.get("MAX_UPDATE_INTERVAL", 60),
+            max_idle_interval=config.get("MAX_IDLE_INTERVAL", 300),
+            max_host_backoff=config.get("MAX_HOST_BACKOFF", 600)
+        )
+        self.delivery_queue = DeliveryQueue(
+            global_rate=config.get("TG_GLOBAL_RATE", 25),
+            chat_rate=config.get("TG_CHAT_RATE", 1),
+            workers=config.get("DELIVERY_WORKERS", 4)
+        )
+        self.renderer = PlotRenderer(
+            config.get("RENDER_WORKERS"),
+            config.get("PLOT_CACHE_SIZE", 256),
+            config.get("PLOT_MAX_POINTS", 1000),
+            dashboard_size=(config.get("DASHBOARD_WIDTH", 8), config.get("DASHBOARD_HEIGHT", 3.5)),
+            dashboard_dpi=config.get("DASHBOARD_DPI", 72),
+            sparkline_width=config.get("SPARKLINE_WIDTH", 20)
+        )
+        self.default_delivery_mode = config.get("DELIVERY_MODE", DELIVERY_MODES[0])
+        self.backfill_executor = ThreadPoolExecutor(
+            max_workers=config.get("BACKFILL_WORKERS", 2),
+            thread_name_prefix='backfill'
+        )
+        self.update_engine = UpdateEngine(
+            self.send_updates_to_user,
+            max_workers=config.get("UPDATE_WORKERS", 8),
+            user_timeout=config.get("USER_UPDATE_TIMEOUT", 30),
+            on_cycle_start=self.poller.start_cycle,
+            slow_cycle_threshold=config.get("SLOW_CYCLE_THRESHOLD"),
+            trace_dir=config.get("SLOW_CYCLE_TRACE_DIR", "database/traces")
+        )
+        self.alert_engine = AlertEngine(database)
+        self.lifecycle = LifecycleManager(
+            database,
+            self.user_sessions,
+            metrics_ttl=config.get("METRICS_TTL_DAYS", 7) * 24 * 3600,
+            archive_ttl=config.get("ARCHIVE_TTL_DAYS", 90) * 24 * 3600,
+            idle_client_ttl=config.get("IDLE_CLIENT_TTL", 3600),
+            maintain_database=self.shard_index is None
+        )
 
         def send_and_log(message, chat_id):
             logging.info(message)
@@ -36,6 +108,10 @@ class ClearMLBot:
                 "/subscribe - Subscribe ClearML updates\n"
                 "/unsubscribe - Stop receiving ClearML updates\n"
                 "/experiments - Get info about running experiments\n"
+                "/mode - Choose how updates look: separate charts, one dashboard image or text sparklines\n"
+                "/alert - Get notified when a metric crosses a value, stops improving or diverges\n"
+                "/alerts - List your alerts\n"
+                "/delalert <id> - Delete an alert\n"
                 "/help - Print help message\n"
             )
 
@@ -59,6 +135,10 @@ class ClearMLBot:
                 return
             if self.subscribe_user(chat_id):
                 send_and_log(f'User {message.chat.username} subscribed to updates!', chat_id)
+                # History of already running experiments is loaded in the background
+                # so the reply above is not held up by it
+                self.backfill_executor.submit(self.user_sessions[chat_id].backfill_running_experiments, chat_id,
+                                              self.snapshot_ttl)
 
         @self.bot.message_handler(commands=['unsubscribe'])
         def unsubscribe_command(message):
@@ -66,7 +146,8 @@ class ClearMLBot:
             if chat_id not in self.user_sessions:
                 send_and_log(f'User "{message.chat.username}" wasn\'t subscribed!', chat_id)
                 return
-            self.user_sessions.pop(chat_id)
+            self.database.remove_subscription(chat_id)
+            self.release_user(chat_id)
             send_and_log(f'User "{message.chat.username}" unsubscribed from updates!', chat_id)
 
         @self.bot.message_handler(commands=['experiments'])
@@ -76,18 +157,143 @@ class ClearMLBot:
                 if not self.subscribe_user(chat_id):
                     return
             
-            user_api_client = self.user_sessions[chat_id]
-            running_experiments = user_api_client.get_running_experiments()
-            
-            message = f'Running experiment count: {len(running_experiments)}'
-            for experiment in running_experiments:
-                message += '\n\n'
-                message += f'Name: {experiment["name"]}\n'
-                message += f'  - Id: {experiment["id"]}\n'
-                message += f'  - Epoch: {experiment["iteration"]}\n'
-                message += f'  - Duration: {experiment["duration"]}'
-            
-            self.bot.send_message(chat_id, message)
+            text, markup = self.get_experiments_page(chat_id, 0)
+            self.bot.send_message(chat_id, text, reply_markup=markup)
+
+        @self.bot.message_handler(commands=['mode'])
+        def mode_command(message):
+            chat_id = message.chat.id
+            tokens = message.text.split()
+            if len(tokens) != 2 or tokens[1].lower() not in DELIVERY_MODES:
+                current_mode = self.database.get_delivery_mode(chat_id) or self.default_delivery_mode
+                self.bot.send_message(chat_id, f'Current mode: {current_mode}\n'
+                                               f'Usage: /mode <{"|".join(DELIVERY_MODES)}>')
+                return
+            delivery_mode = tokens[1].lower()
+            self.database.set_delivery_mode(chat_id, delivery_mode)
+            user_api_client = self.user_sessions.get(chat_id)
+            if user_api_client is not None:
+                user_api_client.delivery_mode = delivery_mode
+            send_and_log(f'Updates for {message.chat.username} will be sent as {delivery_mode}', chat_id)
+
+        @self.bot.message_handler(commands=['alert'])
+        def alert_command(message):
+            chat_id = message.chat.id
+            try:
+                section, metric, kind, threshold, window = parse_rule(message.text)
+            except ValueError:
+                self.bot.send_message(chat_id, ALERT_USAGE)
+                return
+            rule = self.alert_engine.add_rule(chat_id, section, metric, kind, threshold, window)
+            send_and_log(f'Alert #{rule.rule_id} added: {rule.describe()}', chat_id)
+
+        @self.bot.message_handler(commands=['alerts'])
+        def alerts_command(message):
+            chat_id = message.chat.id
+            rules = self.alert_engine.list_rules(chat_id)
+            if not rules:
+                self.bot.send_message(chat_id, "No alerts. " + ALERT_USAGE)
+                return
+            self.bot.send_message(chat_id, '\n'.join(f'#{rule.rule_id}: {rule.describe()}' for rule in rules))
+
+        @self.bot.message_handler(commands=['delalert'])
+        def delete_alert_command(message):
+            chat_id = message.chat.id
+            tokens = message.text.split()
+            if len(tokens) != 2 or not tokens[1].lstrip('#').isdigit():
+                self.bot.send_message(chat_id, "Usage: /delalert <id>")
+                return
+            rule_id = int(tokens[1].lstrip('#'))
+            if self.alert_engine.delete_rule(chat_id, rule_id):
+                send_and_log(f'Alert #{rule_id} deleted', chat_id)
+            else:
+                self.bot.send_message(chat_id, f'Alert #{rule_id} not found')
+
+        @self.bot.callback_query_handler(func=lambda call: call.data.startswith('experiments:'))
+        def experiments_page(call):
+            chat_id = call.message.chat.id
+            if chat_id not in self.user_sessions:
+                self.bot.answer_callback_query(call.id)
+                return
+            text, markup = self.get_experiments_page(chat_id, int(call.data.split(':')[1]))
+            try:
+                self.bot.edit_message_text(text, chat_id, call.message.message_id, reply_markup=markup)
+            except telebot.apihelper.ApiTelegramException as e:
+                if 'message is not modified' not in e.description:
+                    raise
+            self.bot.answer_callback_query(call.id)
+
+    def get_experiments_page(self, chat_id, page):
+        user_api_client = self.user_sessions[chat_id]
+        snapshot = self.poller.get_snapshot(chat_id, user_api_client, self.snapshot_ttl)
+        # Pages are built once per snapshot and shared by everyone in its poll group
+        if snapshot.pages is None:
+            running_experiments = user_api_client.get_running_experiments(snapshot.running_tasks)
+            snapshot.pages = self._build_experiment_pages(running_experiments)
+        pages = snapshot.pages
+        page = max(0, min(page, len(pages) - 1))
+
+        markup = None
+        if len(pages) > 1:
+            buttons = []
+            if page > 0:
+                buttons.append(telebot.types.InlineKeyboardButton('« Prev', callback_data=f'experiments:{page - 1}'))
+            buttons.append(telebot.types.InlineKeyboardButton(f'{page + 1}/{len(pages)}',
+                                                              callback_data=f'experiments:{page}'))
+            if page < len(pages) - 1:
+                buttons.append(telebot.types.InlineKeyboardButton('Next »', callback_data=f'experiments:{page + 1}'))
+            markup = telebot.types.InlineKeyboardMarkup()
+            markup.row(*buttons)
+        return pages[page], markup
+
+    @staticmethod
+    def _build_experiment_pages(running_experiments):
+        entries = []
+        for experiment in running_experiments:
+            entry = '\n'.join([
+                f'Name: {experiment["name"]}',
+                f'  - Id: {experiment["id"]}',
+                f'  - Epoch: {experiment["iteration"]}',
+                f'  - Duration: {experiment["duration"]}'
+            ])
+            entries.append(entry[:EXPERIMENTS_PAGE_CHARS])
+
+        chunks = [[]]
+        chunk_chars = 0
+        for entry in entries:
+            if chunks[-1] and (len(chunks[-1]) == EXPERIMENTS_PAGE_SIZE
+                               or chunk_chars + len(entry) + 2 > EXPERIMENTS_PAGE_CHARS):
+                chunks.append([])
+                chunk_chars = 0
+            chunks[-1].append(entry)
+            chunk_chars += len(entry) + 2
+
+        header = f'Running experiment count: {len(running_experiments)}'
+        if len(chunks) == 1:
+            return ['\n\n'.join([header] + chunks[0])]
+        return ['\n\n'.join([f'{header} (page {number}/{len(chunks)})'] + chunk)
+                for number, chunk in enumerate(chunks, start=1)]
+
+    @staticmethod
+    def _fit_sparklines(sparklines, max_chars):
+        # Whole lines are kept while they fit, with room left for the note on
+        # how many metric lines were cut
+        if len(sparklines) <= max_chars:
+            return sparklines
+        lines = sparklines.split('\n')
+        kept = []
+        chars = 0
+        for line in lines:
+            if chars + len(line) + 1 > max_chars - 32:
+                break
+            kept.append(line)
+            chars += len(line) + 1
+        # A section header without any of its metrics is dropped as well
+        if kept and not kept[-1].startswith(' '):
+            kept.pop()
+        cut = sum(line.startswith(' ') for line in lines[len(kept):])
+        kept.append(f'…and {cut} more')
+        return '\n'.join(kept)
 
     def polling(self):
         while True:
@@ -96,25 +302,58 @@ class ClearMLBot:
             except Exception as e:
                 print(f'An error occured in bot.polling: {e}')
 
+    def start_webhook(self, url, host='0.0.0.0', port=8443, secret_token=None, max_workers=8):
+        return start_webhook_server(self.bot, url, host, port, secret_token, max_workers)
+
     def subscribe_user(self, chat_id):
         user_from_db = self.database.get_user_by_id(chat_id)
         if user_from_db is None:
             self.bot.send_message(chat_id, "Use /register to add your ClearML credentials.")
             return False
 
-        _, _, host, api_key, secret_key = user_from_db
-
         if chat_id in self.user_sessions:
             return True
 
+        self.database.add_subscription(chat_id)
+        self._add_user_session(user_from_db)
+        return True
+
+    def restore_subscriptions(self, owns=None):
+        # Clients only authenticate on their first poll, so restoring is just bookkeeping.
+        # A sharded worker passes owns to only take the chats of its shard
+        restored = []
+        for user_from_db in self.database.get_subscribed_users():
+            chat_id = user_from_db[0]
+            if chat_id in self.user_sessions or (owns is not None and not owns(chat_id)):
+                continue
+            self._add_user_session(user_from_db)
+            restored.append(chat_id)
+        logging.info(f'Restored {len(restored)} subscriptions')
+        return restored
+
+    def release_user(self, chat_id):
+        # Stops polling for the chat without touching its subscription
+        user_api_client = self.user_sessions.pop(chat_id, None)
+        if user_api_client is not None:
+            user_api_client.release()
+        self.poller.remove_subscriber(chat_id)
+        self.scheduler.remove_user(chat_id)
+        self.alert_engine.forget_user(chat_id)
+
+    def _add_user_session(self, user_from_db):
+        chat_id, _, host, api_key, secret_key = user_from_db
         user_api_client = ClearML_API_Wrapped(
             host,
             api_key,
             secret_key,
-            self.database
+            self.database,
+            self.poller,
+            self.renderer,
+            self.session_pool
         )
+        user_api_client.delivery_mode = self.database.get_delivery_mode(chat_id) or self.default_delivery_mode
         self.user_sessions[chat_id] = user_api_client
-        return True
+        self.scheduler.add_user(chat_id, host)
 
     def _parse_json(self, text):
         api_server_pattern = r'api_server:\s*(\S+)'
@@ -159,55 +398,117 @@ class ClearMLBot:
             pass
         self.bot.send_message(chat_id, "Registration successful! Your credentials have been saved.")
 
-    def send_updates_to_users(self):
-        for chat_id in self.user_sessions.copy():
-            user_api_client = self.user_sessions[chat_id]
+    def send_updates_to_users(self, users=None):
+        if users is None:
+            users = [(chat_id, user_api_client.host)
+                     for chat_id, user_api_client in self.user_sessions.copy().items()]
+        self.update_engine.run_cycle(users)
+        self.flush_experiments()
+
+    def send_due_updates(self):
+        self.update_engine.run_cycle(self.scheduler.pop_due)
+        self.flush_experiments()
+
+    def flush_experiments(self):
+        # Message state changed by this cycle's and earlier deliveries goes to
+        # disk in one transaction
+        try:
+            with stats.timed("db_flush"):
+                self.database.flush_experiments()
+        except Exception as e:
+            logging.error(f'Flushing experiment state failed: {e}')
+
+    def send_updates_to_user(self, chat_id):
+        user_api_client = self.user_sessions.get(chat_id)
+        if user_api_client is None:
+            return
+        try:
             experiment_infos, train_images, val_images = user_api_client.update_running_experiments(chat_id)
+        except Exception:
+            self.scheduler.record_error(chat_id)
+            raise
+        self.scheduler.record_poll(chat_id, user_api_client.running_iterations)
+        self.alert_engine.retain_experiments(chat_id, user_api_client.running_iterations)
+
+        for experiment_info, train_image, val_image in zip(experiment_infos, train_images, val_images):
+            experiment_id = experiment_info["id"]
+            experiment_name = experiment_info["name"]
+            last_iteration = experiment_info["iteration"]
+            duration_str = experiment_info["duration"]
+            plot_hashes = experiment_info["plot_hashes"]
+            sparklines = experiment_info["sparklines"]
+
+            message =  f'Name: {experiment_name}\n'
+            message += f'  - Id: {experiment_id}\n'
+            message += f'  - Epoch: {last_iteration}\n'
+            message += f'  - Duration: {duration_str}'
+
+            for rule, alert_message in self.alert_engine.process(chat_id, experiment_id, experiment_name,
+                                                                 last_iteration, experiment_info["metrics"]):
+                self.delivery_queue.enqueue(
+                    chat_id, (chat_id, experiment_id, "alert", rule.rule_id),
+                    partial(self.bot.send_message, chat_id, alert_message)
+                )
+
+            experiment_info = self.database.get_experiment_info(chat_id, experiment_id)
+
+            if experiment_info is None:
+                self.database.store_experiment_info(chat_id, experiment_id, experiment_name, last_iteration, -1, -1, -1)
+                experiment_info = self.database.get_experiment_info(chat_id, experiment_id)
 
-            for experiment_info, train_image, val_image in zip(experiment_infos, train_images, val_images):
-                experiment_id = experiment_info["id"]
-                experiment_name = experiment_info["name"]
-                last_iteration = experiment_info["iteration"]
-                duration_str = experiment_info["duration"]
+            _, _, _, last_iteration_db, text_msg_id, train_msg_id, val_msg_id = experiment_info
+            if last_iteration == last_iteration_db:
+                continue
+
+            # Deliveries are keyed by (chat, experiment, message kind): while one is
+            # queued, a newer update for the same message replaces it
+            if user_api_client.delivery_mode == "dashboard":
+                self.delivery_queue.enqueue(
+                    chat_id, (chat_id, experiment_id, "dashboard"),
+                    partial(self.send_or_update_dashboard, chat_id, experiment_id, experiment_name,
+                            last_iteration, message, train_image, plot_hashes["train"])
+                )
+                continue
+            if sparklines:
+                message += '\n\n' + self._fit_sparklines(sparklines, MESSAGE_CHARS - len(message) - 2)
+
+            self.delivery_queue.enqueue(
+                chat_id, (chat_id, experiment_id, "text"),
+                partial(self.send_or_update_text, chat_id, experiment_id,
+                        experiment_name, last_iteration, message)
+            )
 
-                message =  f'Name: {experiment_name}\n'
-                message += f'  - Id: {experiment_id}\n'
-                message += f'  - Epoch: {last_iteration}\n'
-                message += f'  - Duration: {duration_str}'
+            if train_image is not None:
+                self.delivery_queue.enqueue(
+                    chat_id, (chat_id, experiment_id, "train"),
+                    partial(self.send_or_update_photo, chat_id, experiment_id, experiment_name,
+                            last_iteration, train_image, "train", plot_hashes["train"])
+                )
+            if val_image is not None:
+                self.delivery_queue.enqueue(
+                    chat_id, (chat_id, experiment_id, "val"),
+                    partial(self.send_or_update_photo, chat_id, experiment_id, experiment_name,
+                            last_iteration, val_image, "val", plot_hashes["val"])
+                )
+
+    def send_or_update_text(self, chat_id, experiment_id, experiment_name, last_iteration, message):
+        # Message ids are read when the delivery runs, not when it was queued,
+        # so a message sent by an earlier delivery is edited rather than re-sent
+        experiment_info = self.database.get_experiment_info(chat_id, experiment_id)
 
-                experiment_info = self.database.get_experiment_info(chat_id, experiment_id)
+        _, _, _, _, text_msg_id, train_msg_id, val_msg_id = experiment_info
+        if text_msg_id != -1:
+            sent_message = self.bot.edit_message_text(message, chat_id, text_msg_id)
+        else:
+            sent_message = self.bot.send_message(chat_id, message)
+            train_msg_id, val_msg_id = -1, -1
+
+        self.database.store_experiment_info(chat_id, experiment_id, 
+                                            experiment_name, last_iteration, 
+                                            sent_message.message_id, train_msg_id, val_msg_id)
 
-                if experiment_info is None:
-                    self.database.store_experiment_info(chat_id, experiment_id, experiment_name, last_iteration, -1, -1, -1)
-                    experiment_info = self.database.get_experiment_info(chat_id, experiment_id)
-
-                _, _, _, last_iteration_db, text_msg_id, train_msg_id, val_msg_id = experiment_info
-                if last_iteration == last_iteration_db:
-                    continue
-                
-                if text_msg_id != -1:
-                    _, _, _, _, text_msg_id, train_msg_id, val_msg_id = experiment_info
-                    try:
-                        sent_message = self.bot.edit_message_text(message, chat_id, text_msg_id)
-                        self.database.store_experiment_info(chat_id, experiment_id, 
-                                                            experiment_name, last_iteration, 
-                                                            sent_message.message_id, train_msg_id, val_msg_id)
-                    except Exception:
-                        pass
-                else:
-                    sent_message = self.bot.send_message(chat_id, message)
-                    self.database.store_experiment_info(chat_id, experiment_id, 
-                                                        experiment_name, last_iteration, 
-                                                        sent_message.message_id, -1, -1)
-
-                if train_image is not None:
-                    self.send_or_update_photo(chat_id, experiment_id, experiment_name, 
-                                              last_iteration, train_image, "train")
-                if val_image is not None:
-                    self.send_or_update_photo(chat_id, experiment_id, experiment_name, 
-                                              last_iteration, val_image, "val")
-
-    def send_or_update_photo(self, chat_id, experiment_id, experiment_name, last_iteration, image, section):
+    def send_or_update_photo(self, chat_id, experiment_id, experiment_name, last_iteration, image, section,
+                             plot_hash=None):
         if section not in ["train", "val"]:
             print(f'Section {section} not in ["train", "val"]')
             return
@@ -219,12 +520,11 @@ class ClearMLBot:
         elif section == "val":
             message_id = val_msg_id
 
+        # The same image may be uploaded again after a failed attempt
+        image.seek(0)
         if message_id != -1:
-            try:
-                sent_message = self.bot.edit_message_media(chat_id=chat_id, message_id=message_id, 
+            sent_message = self.bot.edit_message_media(chat_id=chat_id, message_id=message_id, 
                                                        media=telebot.types.InputMediaPhoto(image))
-            except Exception:
-                return
         else:
             sent_message = self.bot.send_photo(chat_id, image)
 
@@ -233,9 +533,41 @@ class ClearMLBot:
         elif section == "val":
             val_msg_id = sent_message.message_id
 
+        if plot_hash is not None:
+            self.database.store_plot_hash(chat_id, sent_message.message_id, plot_hash)
         self.database.store_experiment_info(chat_id, experiment_id,
                                             experiment_name, last_iteration, 
                                             text_msg_id, train_msg_id, val_msg_id)
 
+    def send_or_update_dashboard(self, chat_id, experiment_id, experiment_name, last_iteration, caption, image,
+                                 plot_hash=None):
+        # The dashboard image carries the experiment text as its caption and
+        # lives in the train chart's message slot
+        experiment_info = self.database.get_experiment_info(chat_id, experiment_id)
+
+        _, _, _, _, text_msg_id, dashboard_msg_id, val_msg_id = experiment_info
+        if image is None:
+            if dashboard_msg_id == -1:
+                # Nothing is plotted yet, the text goes out on its own meanwhile
+                self.send_or_update_text(chat_id, experiment_id, experiment_name, last_iteration, caption)
+                return
+            self.bot.edit_message_caption(caption, chat_id, dashboard_msg_id)
+        else:
+            image.seek(0)
+            if dashboard_msg_id != -1:
+                sent_message = self.bot.edit_message_media(
+                    chat_id=chat_id, message_id=dashboard_msg_id,
+                    media=telebot.types.InputMediaPhoto(image, caption=caption)
+                )
+            else:
+                sent_message = self.bot.send_photo(chat_id, image, caption=caption)
+            dashboard_msg_id = sent_message.message_id
+            if plot_hash is not None:
+                self.database.store_plot_hash(chat_id, dashboard_msg_id, plot_hash)
+
+        self.database.store_experiment_info(chat_id, experiment_id,
+                                            experiment_name, last_iteration,
+                                            text_msg_id, dashboard_msg_id, val_msg_id)
+
     def start_bot(self):
         self.bot.polling()
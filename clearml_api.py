@@ -1,33 +1,103 @@
 import io
+import logging
+import threading
+import time
 from datetime import datetime
 
-import numpy as np
-from clearml import Task
-from clearml.backend_api.session import Session
-from clearml.backend_api.session.client import APIClient
-from matplotlib import pyplot as plt
+from instrumentation import stats
+from rendering import (DASHBOARD_DPI, DASHBOARD_SIZE, DEFAULT_MAX_POINTS, SPARKLINE_WIDTH, downsample, plot_hash,
+                       render_dashboard, render_inline, render_plot, sparkline)
+
+# clearml and numpy are imported on first use: they are slow to load and the
+# bot has to answer commands before any experiment is polled
+
+IN_PROGRESS_STATUS = "in_progress"
+PLOTTED_SECTIONS = ["train", "val"]
+BACKFILL_SAMPLES = 10000
+RUNNING_TASK_FIELDS = ["id", "name", "last_iteration", "started", "last_metrics"]
+# separate: a text message and one chart per section; dashboard: one compact
+# image with every section and the text as its caption; sparkline: text only
+DELIVERY_MODES = ["separate", "dashboard", "sparkline"]
+
+
+class RunningTask:
+    __slots__ = ("id", "name", "last_iteration", "started", "last_metrics")
+
+    def __init__(self, id, name, last_iteration, started, last_metrics):
+        self.id = id
+        self.name = name
+        self.last_iteration = last_iteration
+        self.started = started
+        self.last_metrics = last_metrics
+
+    @classmethod
+    def from_response(cls, task):
+        started = task.get("started")
+        if isinstance(started, str):
+            started = datetime.fromisoformat(started.replace("Z", "+00:00"))
+        return cls(
+            task["id"],
+            task.get("name", ""),
+            task.get("last_iteration") or 0,
+            started,
+            task.get("last_metrics") or {}
+        )
 
 
-class ClearML_API_Wrapped(APIClient):
-    def __init__(self, host, api_key, secret_key, database):
+class ClearML_API_Wrapped:
+    def __init__(self, host, api_key, secret_key, database, poller=None, renderer=None, session_pool=None):
         self.db = database
-        session = Session(
-            host=host,
-            api_key=api_key,
-            secret_key=secret_key
-        )
-
-        self.client = super(ClearML_API_Wrapped, self).__init__(
-            session=session
-        )
+        self.host = host
+        self.api_key = api_key
+        self.secret_key = secret_key
+        self.poller = poller
+        self.renderer = renderer
+        self.session_pool = session_pool
+        self.poll_group = None
+        self._session = None
+        self._session_lock = threading.Lock()
         
         self.running_tasks = {}
+        self.running_iterations = {}
+        self.last_active = time.time()
+        # Experiments that finished while the bot was down are only found by
+        # comparing the stored ones with the first poll
+        self.reconciled = False
+        # (experiment_id, section) -> SectionSeries
+        self.metric_history = {}
+        # experiment_id -> {(section, metric): [value, stored iteration, last seen iteration]}
+        self.metric_snapshots = {}
+        # (experiment_id, section) -> hash of the last plotted series
+        self.plotted_hashes = {}
+        self.delivery_mode = DELIVERY_MODES[0]
+        # (experiment_id, section) -> sparkline text of the section
+        self.sparklines = {}
+
+    @property
+    def api_session(self):
+        # Creating a Session logs in to the server, so it waits for the first request
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None and self.session_pool is not None:
+                    # Clients of the same server share connections, and of the same
+                    # credentials also share the token
+                    self._session = self.session_pool.get_session(self.host, self.api_key, self.secret_key)
+                elif self._session is None:
+                    from clearml.backend_api.session import Session
+                    self._session = Session(
+                        host=self.host,
+                        api_key=self.api_key,
+                        secret_key=self.secret_key
+                    )
+        return self._session
 
     @staticmethod
-    def _get_duration(running_task_dict):
-        tz = running_task_dict["started"].tzinfo
+    def _get_duration(running_task):
+        if running_task.started is None:
+            return '0H:0m'
+        tz = running_task.started.tzinfo
         datetime_now = datetime.now(tz=tz)
-        experiment_duration = datetime_now - running_task_dict["started"]
+        experiment_duration = datetime_now - running_task.started
         days = experiment_duration.days
         hours = experiment_duration.seconds // 3600
         minutes = (experiment_duration.seconds // 60) % 60
@@ -39,24 +109,113 @@ class ClearML_API_Wrapped(APIClient):
 
         return duration_str
 
-    def get_running_experiments(self):
-        running_task_list = self.tasks.get_all(status=[Task.TaskStatusEnum.in_progress.value])
+    def get_running_tasks(self):
+        # A raw request with only_fields skips the server sending, and the client
+        # building response models for, configs and hyperparameters we never read
+        with stats.timed("clearml_fetch", host=self.host):
+            response = self.api_session.send_request(
+                service="tasks",
+                action="get_all",
+                method="post",
+                json={
+                    "status": [IN_PROGRESS_STATUS],
+                    "only_fields": RUNNING_TASK_FIELDS
+                }
+            )
+            response.raise_for_status()
+            tasks = response.json()["data"]["tasks"]
+        stats.increment("clearml_bot_clearml_requests_total", host=self.host)
+        return [RunningTask.from_response(task) for task in tasks]
+
+    def get_poll_group(self):
+        # Users of the same server and workspace see the same running tasks,
+        # so they can share one poll
+        if self.poll_group is None:
+            try:
+                response = self.api_session.send_request(
+                    service="users",
+                    action="get_current_user",
+                    method="post",
+                    json={}
+                )
+                response.raise_for_status()
+                workspace = response.json()["data"]["user"]["company"]["id"]
+            except Exception as e:
+                print(f'Could not get workspace for {self.host}, polling it separately: {e}')
+                workspace = f'key:{self.api_key}'
+            self.poll_group = (self.host.rstrip('/'), workspace)
+        return self.poll_group
+
+    def get_scalar_history(self, experiment_id):
+        # One events request returns every reported point of every scalar of the task
+        with stats.timed("clearml_history", host=self.host, experiment=experiment_id):
+            response = self.api_session.send_request(
+                service="events",
+                action="scalar_metrics_iter_histogram",
+                method="post",
+                json={
+                    "task": experiment_id,
+                    "key": "iter",
+                    "samples": BACKFILL_SAMPLES
+                }
+            )
+            response.raise_for_status()
+            history = response.json()["data"]
+        stats.increment("clearml_bot_clearml_requests_total", host=self.host)
+        return history
+
+    def backfill_experiment(self, chat_id, experiment_id):
+        history = self.get_scalar_history(experiment_id)
+
+        all_metrics = []
+        for section in PLOTTED_SECTIONS:
+            for metric_name, points in history.get(section, {}).items():
+                all_metrics.extend(
+                    (chat_id, experiment_id, section, metric_name, int(iteration), value)
+                    for iteration, value in zip(points["x"], points["y"])
+                    if value is not None
+                )
+
+        if all_metrics:
+            with stats.timed("db_ingest", host=self.host, user=chat_id, points=len(all_metrics)):
+                self.db.insert_metrics(all_metrics)
+        # The in-memory history only reads forward from its last iteration, so
+        # it is dropped and rebuilt from the database with the backfilled points
+        for section in PLOTTED_SECTIONS:
+            self.metric_history.pop((experiment_id, section), None)
+            self.plotted_hashes.pop((experiment_id, section), None)
+            self.sparklines.pop((experiment_id, section), None)
+        self.plotted_hashes.pop((experiment_id, "dashboard"), None)
+        return len(all_metrics)
+
+    def backfill_running_experiments(self, chat_id, snapshot_ttl=15):
+        # The running tasks come from the poll group's snapshot when it is fresh,
+        # so a /subscribe does not poll the server once more
+        if self.poller is not None:
+            running_task_list = self.poller.get_snapshot(chat_id, self, snapshot_ttl).running_tasks
+        else:
+            running_task_list = self.get_running_tasks()
+        for running_task in running_task_list:
+            try:
+                points = self.backfill_experiment(chat_id, running_task.id)
+                logging.info(f'Backfilled {points} points of {running_task.name} for user {chat_id}')
+            except Exception as e:
+                logging.warning(f'Failed to backfill {running_task.name} for user {chat_id}: {e}')
+
+    def get_running_experiments(self, running_task_list=None):
+        if running_task_list is None:
+            running_task_list = self.get_running_tasks()
         if not len(running_task_list):
             return []
 
         running_experiments = []
         for running_task in running_task_list:
-            running_task_dict = running_task.to_dict()
-            id = running_task_dict["id"]
-            name = running_task_dict["name"]
-            iteration = running_task_dict["last_iteration"]
-
-            duration_str = ClearML_API_Wrapped._get_duration(running_task_dict)
+            duration_str = ClearML_API_Wrapped._get_duration(running_task)
             
             running_experiments.append({
-                "id": id,
-                "name": name,
-                "iteration": iteration,
+                "id": running_task.id,
+                "name": running_task.name,
+                "iteration": running_task.last_iteration,
                 "duration": duration_str
             })
 
@@ -66,49 +225,78 @@ class ClearML_API_Wrapped(APIClient):
         experiment_infos = []
         train_images = []
         val_images = []
-        running_task_list = self.tasks.get_all(status=[Task.TaskStatusEnum.in_progress.value])
+        if self.poller is not None:
+            running_task_list = self.poller.get_running_tasks(chat_id, self)
+        else:
+            running_task_list = self.get_running_tasks()
+        self.running_iterations = {task.id: task.last_iteration for task in running_task_list}
+        self._evict_finished_experiments(chat_id)
+        if not self.reconciled:
+            self._reconcile_finished_experiments(chat_id)
         if not len(running_task_list):
             return experiment_infos, train_images, val_images
+        self.last_active = time.time()
 
+        updated_tasks = []
+        all_metrics = []
+        changed_sections = {}
+        experiment_points = {}
         for running_task in running_task_list:
-            running_task_dict = running_task.to_dict()
-            experiment_id = running_task_dict["id"]
-            experiment_name = running_task_dict["name"]
-            last_iteration = running_task_dict["last_iteration"]
+            experiment_id = running_task.id
+            last_iteration = running_task.last_iteration
     
             if self.running_tasks.get(experiment_id, -1) == last_iteration:
                 continue
 
+            if experiment_id not in self.running_tasks:
+                # A task can be resumed after it was seen finishing; its compacted
+                # history goes back to the metrics table, which may have expired
+                self._restore_archived_metrics(chat_id, experiment_id)
+                self.db.unmark_experiment_finished(chat_id, experiment_id)
+
             self.running_tasks[experiment_id] = last_iteration
-            last_task_metrics = running_task.last_metrics
-
-            all_metrics = []
-            for metric_info in ClearML_API_Wrapped._extract_metrics(last_task_metrics):
-                if metric_info["section"] in ["train", "val"]:
-                    metric_iteration = last_iteration
-                    if metric_info["metric"] != "lr":
-                        metric_iteration -= 1
-                    all_metrics.append((
-                        chat_id,
-                        experiment_id,
-                        metric_info["section"],
-                        metric_info["metric"],
-                        metric_iteration,
-                        metric_info["value"]
-                    ))
-
-            for metric_data in all_metrics:
-                self.db.insert_metric(*metric_data)
-
-            train_image, val_image = self.plot_metrics_for_experiment(experiment_id, experiment_name)
-
-            duration_str = ClearML_API_Wrapped._get_duration(running_task_dict)
+
+            with stats.timed("extract_metrics", host=self.host, user=chat_id, experiment=experiment_id):
+                changed_metrics = self._diff_metrics(experiment_id, running_task.last_metrics, last_iteration)
+
+            for section, metric, metric_iteration, value in changed_metrics:
+                all_metrics.append((chat_id, experiment_id, section, metric, metric_iteration, value))
+            changed_sections[experiment_id] = {section for section, _, _, _ in changed_metrics}
+            experiment_points[experiment_id] = all_metrics[-len(changed_metrics):] if changed_metrics else []
+
+            updated_tasks.append(running_task)
+
+        # The whole cycle's points for this user go to the database in one transaction
+        if all_metrics:
+            with stats.timed("db_ingest", host=self.host, user=chat_id, points=len(all_metrics)):
+                self.db.insert_metrics(all_metrics)
+
+        # All charts of the cycle are submitted first and rendered in parallel
+        render_jobs = [
+            self.plot_metrics_for_experiment(chat_id, running_task.id, running_task.name,
+                                             changed_sections[running_task.id])
+            for running_task in updated_tasks
+        ]
+
+        for running_task, (train_job, val_job, plot_hashes) in zip(updated_tasks, render_jobs):
+            experiment_id = running_task.id
+            experiment_name = running_task.name
+            last_iteration = running_task.last_iteration
+
+            train_image = self._collect_image(train_job, chat_id, experiment_id, "train")
+            val_image = self._collect_image(val_job, chat_id, experiment_id, "val")
+
+            duration_str = ClearML_API_Wrapped._get_duration(running_task)
 
             experiment_infos.append({
                 "id": experiment_id,
                 "name": experiment_name,
                 "iteration": last_iteration,
-                "duration": duration_str
+                "duration": duration_str,
+                "plot_hashes": plot_hashes,
+                "sparklines": self.get_sparklines(experiment_id) if self.delivery_mode == "sparkline" else None,
+                # (section, metric, iteration, value) that changed in this poll
+                "metrics": [point[2:] for point in experiment_points[experiment_id]]
             })
 
             train_images.append(train_image)
@@ -116,96 +304,252 @@ class ClearML_API_Wrapped(APIClient):
 
         return experiment_infos, train_images, val_images
     
-    @staticmethod
-    def _extract_metrics(data):
-        metrics = [] 
+    def _evict_finished_experiments(self, chat_id):
+        finished = [experiment_id for experiment_id in self.running_tasks
+                    if experiment_id not in self.running_iterations]
+        for experiment_id in finished:
+            self.db.mark_experiment_finished(chat_id, experiment_id, time.time())
+            self.running_tasks.pop(experiment_id)
+            self.metric_snapshots.pop(experiment_id, None)
+            for section in PLOTTED_SECTIONS:
+                self.metric_history.pop((experiment_id, section), None)
+                self.plotted_hashes.pop((experiment_id, section), None)
+                self.sparklines.pop((experiment_id, section), None)
+            self.plotted_hashes.pop((experiment_id, "dashboard"), None)
+
+    def _reconcile_finished_experiments(self, chat_id):
+        finished_at = time.time()
+        for experiment_id in self.db.get_experiment_ids(chat_id):
+            if experiment_id not in self.running_iterations:
+                self.db.mark_experiment_finished(chat_id, experiment_id, finished_at)
+        self.reconciled = True
+
+    def _restore_archived_metrics(self, chat_id, experiment_id):
+        archives = self.db.get_metric_archives(chat_id, experiment_id)
+        if not archives:
+            return
+        from metric_store import SectionSeries
+
+        all_metrics = []
+        for section, data in archives:
+            section_series = SectionSeries.from_blob(data)
+            for metric_name, iterations, values in section_series.series():
+                all_metrics.extend(
+                    (chat_id, experiment_id, section, metric_name, int(iteration), float(value))
+                    for iteration, value in zip(iterations, values)
+                )
+        if all_metrics:
+            self.db.insert_metrics(all_metrics)
+
+    def release(self):
+        # Hands back the session and drops the cached history of an idle or
+        # removed client; both are rebuilt on the next poll
+        with self._session_lock:
+            session, self._session = self._session, None
+        if session is not None and self.session_pool is not None:
+            self.session_pool.release_session(session)
+        self.metric_history.clear()
+        self.metric_snapshots.clear()
+        self.plotted_hashes.clear()
+        self.sparklines.clear()
 
+    @staticmethod
+    def _iter_metrics(data):
+        # last_metrics nests {metric hash: {variant hash: event}}; only the fields
+        # the bot stores are read from each event
         for item in data.values():
             if 'metric' in item:
-                if ":monitor:" in item['metric']:
-                    continue
-                metrics.append({
-                    'section': item['metric'], 
-                    'metric': item['variant'],
-                    'value': item['value'],
-                    'min_value': item['min_value'],
-                    'max_value': item['max_value'],
-                    'min_value_iteration': item['min_value_iteration'],
-                    'max_value_iteration': item['max_value_iteration']
-                })
+                if item['metric'] in PLOTTED_SECTIONS:
+                    yield item['metric'], item['variant'], item['value']
             else:
-                metrics.extend(ClearML_API_Wrapped._extract_metrics(item))
-
-        return metrics
+                yield from ClearML_API_Wrapped._iter_metrics(item)
 
     @staticmethod
-    def _get_plot(metrics, metric_type, experiment_name, color_palette):
-        metric_names = [metric[3] for metric in metrics]
-        iterations = [metric[4] for metric in metrics]
-        values = [metric[5] for metric in metrics]
-        unique_metric_names = set(metric_names)
-
-        legend_labels = []
-        plt.figure(figsize=(10, 6))
-
-        for i, metric_name in enumerate(unique_metric_names):
-            mask = [name == metric_name for name in metric_names]
-            metric_iterations = [iterations[j] for j, m in enumerate(mask) if m]
-            metric_values = [values[j] for j, m in enumerate(mask) if m]
-            plt.plot(
-                metric_iterations,
-                metric_values,
-                marker='o',
-                linestyle='-',
-                label=f'{metric_name}',
-                color=color_palette(i)
-            )
-            legend_labels.append(f'{metric_name}: {round(metric_values[-1], 3)}') 
-
-        plt.title(f"{metric_type} metrics for {experiment_name}")
-        plt.xlabel('Iterations')
-        plt.ylabel('Values')
-        if max(iterations) - min(iterations) > 50:
-            iter_step = 2
-        else:
-            iter_step = 1
-        plt.xticks(np.arange(min(iterations), max(iterations) + 1, iter_step))
-        plt.yticks(np.arange(0, 1.01, 0.1))
-        plt.yticks(np.arange(0, 1.0, 0.05), minor=True)
-        plt.grid(axis='y', which='both')
-        ax = plt.gca()
-        ax.set_ylim([-0.05, 1.05])
-        plt.legend(labels=legend_labels, loc='upper center', 
-                    bbox_to_anchor=(0.5, -0.15), shadow=True, ncol=4)
-        plt.tight_layout()
-        img = io.BytesIO()
-        plt.savefig(img, format='png')
-        img.seek(0)
-        plt.close()
-        return img
-    
-    def plot_metrics_for_experiment(self, experiment_id, experiment_name):
-        train_metrics = self.db.get_metrics_by_section(experiment_id, "train")
-        val_metrics = self.db.get_metrics_by_section(experiment_id, "val")
+    def _metric_iteration(metric, last_iteration):
+        return last_iteration if metric == "lr" else last_iteration - 1
+
+    def _diff_metrics(self, experiment_id, last_metrics, last_iteration):
+        # last_metrics has no iteration per variant, so a poll can only tell
+        # whether a value changed. Only changed values are stored; _get_series
+        # carries an unchanged one forward to the current iteration
+        snapshot = self.metric_snapshots.setdefault(experiment_id, {})
+        changed = []
+        for section, metric, value in ClearML_API_Wrapped._iter_metrics(last_metrics):
+            key = (section, metric)
+            metric_iteration = ClearML_API_Wrapped._metric_iteration(metric, last_iteration)
+            held = snapshot.get(key)
+            if held is not None and held[0] == value:
+                held[2] = metric_iteration
+                continue
+            if held is not None and held[2] > held[1]:
+                # The old value is stored where it was last seen, so the chart
+                # steps where the value changed instead of sloping towards it
+                changed.append((section, metric, held[2], held[0]))
+            snapshot[key] = [value, metric_iteration, metric_iteration]
+            changed.append((section, metric, metric_iteration, value))
+        return changed
+
+    def _get_section_metrics(self, chat_id, experiment_id, section, changed=True):
+        from metric_store import SectionSeries
+
+        history_key = (experiment_id, section)
+        section_series = self.metric_history.get(history_key)
+        if section_series is not None and not changed:
+            return section_series
+        if section_series is None:
+            section_series = self.metric_history[history_key] = SectionSeries()
+        # Points of the last seen iteration are re-read too: metrics of one
+        # iteration can arrive across polls and replace each other
+        section_series.merge(self.db.get_metric_points(
+            chat_id, experiment_id, section, section_series.last_iteration
+        ))
+        return section_series
 
-        all_metrics = train_metrics + val_metrics
-        unique_metrics = set(metric[3] for metric in all_metrics)
+    @staticmethod
+    def _get_series(section_series, color_indices, max_points=DEFAULT_MAX_POINTS, last_iteration=None):
+        import numpy as np
+
+        series = []
+        for metric_name, iterations, values in section_series.series():
+            if last_iteration is not None:
+                # A metric holds its last stored value until it changes
+                metric_iteration = ClearML_API_Wrapped._metric_iteration(metric_name, last_iteration)
+                if iterations[-1] < metric_iteration:
+                    iterations = np.append(iterations, metric_iteration)
+                    values = np.append(values, values[-1])
+            iterations, values = downsample(iterations, values, max_points)
+            series.append((metric_name, color_indices[metric_name], iterations, values))
+        return series
+
+    def _collect_image(self, render_job, chat_id, experiment_id, section):
+        if render_job is None:
+            return None
+        try:
+            with stats.timed("render", host=self.host, user=chat_id, experiment=experiment_id, section=section):
+                return io.BytesIO(render_job.result())
+        except Exception as e:
+            print(f'Failed to render plot: {e}')
+            return None
+
+    def _submit_render(self, series, metric_type, experiment_name, num_colors, key):
+        if self.renderer is None:
+            return render_inline(render_plot, series, metric_type, experiment_name, num_colors)
+        return self.renderer.submit(series, metric_type, experiment_name, num_colors, key)
+
+    def _submit_dashboard(self, panels, experiment_name, num_colors, key):
+        if self.renderer is None:
+            return render_inline(render_dashboard, panels, experiment_name, num_colors, DASHBOARD_SIZE, DASHBOARD_DPI)
+        return self.renderer.submit_dashboard(panels, experiment_name, num_colors,
+                                              self.renderer.dashboard_size, self.renderer.dashboard_dpi, key)
+
+    def _get_delivered_hash(self, chat_id, experiment_id, section):
+        experiment_info = self.db.get_experiment_info(chat_id, experiment_id)
+        if experiment_info is None:
+            return None
+        _, _, _, _, _, train_msg_id, val_msg_id = experiment_info
+        message_id = train_msg_id if section == "train" else val_msg_id
+        if message_id == -1:
+            return None
+        return self.db.get_plot_hash(chat_id, message_id)
+
+    def _plot_section(self, chat_id, experiment_id, experiment_name, section, metric_type,
+                      section_series, color_indices, num_colors, changed=True, last_iteration=None):
+        if not len(section_series):
+            return None, None
+        delivered_hash = self._get_delivered_hash(chat_id, experiment_id, section)
+        # An unchanged section that was delivered needs neither downsampling nor
+        # hashing, unless a new metric elsewhere shifted its colors
+        plotted = (delivered_hash, num_colors)
+        if not changed and delivered_hash is not None and self.plotted_hashes.get((experiment_id, section)) == plotted:
+            return None, delivered_hash
+        max_points = self.renderer.max_points if self.renderer is not None else DEFAULT_MAX_POINTS
+        series = ClearML_API_Wrapped._get_series(section_series, color_indices, max_points, last_iteration)
+        series_hash = plot_hash(series, metric_type, experiment_name, num_colors)
+        self.plotted_hashes[(experiment_id, section)] = (series_hash, num_colors)
+        # Nothing plotted changed since the last delivered image: skip render and upload
+        if series_hash == delivered_hash:
+            return None, series_hash
+        return self._submit_render(series, metric_type, experiment_name, num_colors, series_hash), series_hash
+
+    def _plot_dashboard(self, chat_id, experiment_id, experiment_name, sections, color_indices, num_colors,
+                        changed=True, last_iteration=None):
+        # The dashboard takes the train chart's place, so its message id and
+        # delivered hash are the train ones
+        sections = [(metric_type, section_series) for metric_type, section_series in sections
+                    if len(section_series)]
+        if not sections:
+            return None, None
+        delivered_hash = self._get_delivered_hash(chat_id, experiment_id, "train")
+        plotted = (delivered_hash, num_colors)
+        if not changed and delivered_hash is not None and \
+                self.plotted_hashes.get((experiment_id, "dashboard")) == plotted:
+            return None, delivered_hash
+        max_points = self.renderer.max_points if self.renderer is not None else DEFAULT_MAX_POINTS
+        panels = []
+        dashboard_hash = 'dashboard'
+        for metric_type, section_series in sections:
+            series = ClearML_API_Wrapped._get_series(section_series, color_indices, max_points, last_iteration)
+            dashboard_hash = plot_hash(series, metric_type, experiment_name, num_colors, dashboard_hash)
+            panels.append((metric_type, series))
+        self.plotted_hashes[(experiment_id, "dashboard")] = (dashboard_hash, num_colors)
+        if dashboard_hash == delivered_hash:
+            return None, dashboard_hash
+        return self._submit_dashboard(panels, experiment_name, num_colors, dashboard_hash), dashboard_hash
+
+    def get_sparklines(self, experiment_id):
+        lines = []
+        for section in PLOTTED_SECTIONS:
+            section_lines = self.sparklines.get((experiment_id, section))
+            if section_lines is None:
+                section_series = self.metric_history.get((experiment_id, section))
+                if section_series is None:
+                    continue
+                width = self.renderer.sparkline_width if self.renderer is not None else SPARKLINE_WIDTH
+                section_lines = [f'{section}:'] + [
+                    f'  {metric_name} {sparkline(values, width)} {round(float(values[-1]), 3)}'
+                    for metric_name, _, values in section_series.series()
+                ]
+                self.sparklines[(experiment_id, section)] = section_lines
+            if len(section_lines) > 1:
+                lines.extend(section_lines)
+        return '\n'.join(lines)
+
+    def plot_metrics_for_experiment(self, chat_id, experiment_id, experiment_name,
+                                    changed_sections=PLOTTED_SECTIONS):
+        train_changed = "train" in changed_sections
+        val_changed = "val" in changed_sections
+        train_metrics = self._get_section_metrics(chat_id, experiment_id, "train", train_changed)
+        val_metrics = self._get_section_metrics(chat_id, experiment_id, "val", val_changed)
+
+        # Sparklines of changed sections are rebuilt from the series just merged.
+        # This happens in every mode, so switching back to sparklines never shows
+        # ones built before the switch
+        for section in changed_sections:
+            self.sparklines.pop((experiment_id, section), None)
+
+        if self.delivery_mode == "sparkline":
+            return None, None, {"train": None, "val": None}
+
+        unique_metrics = sorted(train_metrics.metric_names() | val_metrics.metric_names())
+        color_indices = {metric_name: i for i, metric_name in enumerate(unique_metrics)}
 
         num_unique_metrics = len(unique_metrics)
-        color_palette = plt.cm.get_cmap('tab10', num_unique_metrics)
+        last_iteration = self.running_tasks.get(experiment_id)
 
-        train_image = None
-        if train_metrics:
-            train_image = ClearML_API_Wrapped._get_plot(
-                train_metrics, "train", 
-                experiment_name, color_palette
+        if self.delivery_mode == "dashboard":
+            dashboard_job, dashboard_hash = self._plot_dashboard(
+                chat_id, experiment_id, experiment_name, [("train", train_metrics), ("Val", val_metrics)],
+                color_indices, num_unique_metrics, train_changed or val_changed, last_iteration
             )
+            return dashboard_job, None, {"train": dashboard_hash, "val": None}
 
-        val_image = None
-        if val_metrics:
-            val_image = ClearML_API_Wrapped._get_plot(
-                val_metrics, "Val", 
-                experiment_name, color_palette
-            )
+        train_job, train_hash = self._plot_section(
+            chat_id, experiment_id, experiment_name, "train", "train",
+            train_metrics, color_indices, num_unique_metrics, train_changed, last_iteration
+        )
+        val_job, val_hash = self._plot_section(
+            chat_id, experiment_id, experiment_name, "val", "Val",
+            val_metrics, color_indices, num_unique_metrics, val_changed, last_iteration
+        )
 
-        return train_image, val_image
+        return train_job, val_job, {"train": train_hash, "val": val_hash}
@@ -1,100 +1,401 @@
 import sqlite3
+import threading
+
+# Values of finished_experiments.compacted: the raw rows are kept, archived
+# next to the raw rows, or only the archive is left
+RAW, COMPACTED, EXPIRED = 0, 1, 2
 
 class Database:
     def __init__(self, db_name='database/clearml.db'):
         self.conn = sqlite3.connect(db_name, check_same_thread=False)
         self.cursor = self.conn.cursor()
+        # The connection and its cursor are shared by the update workers
+        self.lock = threading.RLock()
+        self.set_pragmas()
         self.create_table()
+        self.load_experiments()
+
+    def set_pragmas(self):
+        with self.lock:
+            # Only takes effect on a new database; existing ones are converted by
+            # enable_incremental_vacuum
+            self.cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            self.cursor.execute('PRAGMA journal_mode = WAL')
+            # With WAL, NORMAL only syncs on checkpoints; a crash can lose the last
+            # transactions but never corrupts the database
+            self.cursor.execute('PRAGMA synchronous = NORMAL')
+            self.cursor.execute('PRAGMA cache_size = -16000')
+            self.cursor.execute('PRAGMA temp_store = MEMORY')
 
     def create_table(self):
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                host TEXT,
-                api_key TEXT,
-                secret_key TEXT
-            )
-        ''')
-
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS metrics (
-                user_id INTEGER,
-                experiment_id TEXT,
-                section TEXT,
-                metric_name TEXT,
-                iteration INTEGER,
-                value REAL,
-                PRIMARY KEY (user_id, experiment_id, section, metric_name, iteration)
-            )
-        ''')
-
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS experiments (
-                user_id INTEGER,
-                experiment_id TEXT,
-                experiment_name TEXT,
-                last_iteration INTEGER,
-                text_msg_id INTEGER,
-                train_msg_id INTEGER,
-                val_msg_id INTEGER,
-                PRIMARY KEY (user_id, experiment_id)
-            )
-        ''')
-
-        self.conn.commit()
+        with self.lock:
+            self.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id INTEGER PRIMARY KEY,
+                    username TEXT,
+                    host TEXT,
+                    api_key TEXT,
+                    secret_key TEXT
+                )
+            ''')
+
+            self.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS metrics (
+                    user_id INTEGER,
+                    experiment_id TEXT,
+                    section TEXT,
+                    metric_name TEXT,
+                    iteration INTEGER,
+                    value REAL,
+                    PRIMARY KEY (user_id, experiment_id, section, metric_name, iteration)
+                )
+            ''')
+
+            self.cursor.execute('''
+                CREATE INDEX IF NOT EXISTS metrics_by_section_iteration
+                ON metrics (user_id, experiment_id, section, iteration)
+            ''')
+
+            self.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS experiments (
+                    user_id INTEGER,
+                    experiment_id TEXT,
+                    experiment_name TEXT,
+                    last_iteration INTEGER,
+                    text_msg_id INTEGER,
+                    train_msg_id INTEGER,
+                    val_msg_id INTEGER,
+                    PRIMARY KEY (user_id, experiment_id)
+                )
+            ''')
+
+            self.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS subscriptions (
+                    user_id INTEGER PRIMARY KEY
+                )
+            ''')
+
+            self.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS finished_experiments (
+                    user_id INTEGER,
+                    experiment_id TEXT,
+                    finished_at REAL,
+                    compacted INTEGER DEFAULT 0,
+                    PRIMARY KEY (user_id, experiment_id)
+                )
+            ''')
+
+            self.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS metric_archives (
+                    user_id INTEGER,
+                    experiment_id TEXT,
+                    section TEXT,
+                    points INTEGER,
+                    data BLOB,
+                    PRIMARY KEY (user_id, experiment_id, section)
+                )
+            ''')
+
+            self.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS plot_hashes (
+                    user_id INTEGER,
+                    message_id INTEGER,
+                    plot_hash TEXT,
+                    PRIMARY KEY (user_id, message_id)
+                )
+            ''')
+
+            self.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS user_settings (
+                    user_id INTEGER PRIMARY KEY,
+                    delivery_mode TEXT
+                )
+            ''')
+
+            self.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS alert_rules (
+                    rule_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    section TEXT,
+                    metric_name TEXT,
+                    kind TEXT,
+                    threshold REAL,
+                    window INTEGER
+                )
+            ''')
+
+            self.conn.commit()
 
     def insert_user(self, user_id, username, host, api_key, secret_key):
-        self.cursor.execute('''
-            INSERT INTO users (user_id, username, host, api_key, secret_key)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, username, host, api_key, secret_key))
-        self.conn.commit()
+        with self.lock:
+            self.cursor.execute('''
+                INSERT INTO users (user_id, username, host, api_key, secret_key)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (user_id, username, host, api_key, secret_key))
+            self.conn.commit()
 
     def get_user_by_username(self, username):
-        self.cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
-        return self.cursor.fetchone()
+        with self.lock:
+            self.cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
+            return self.cursor.fetchone()
 
     def get_user_by_id(self, user_id):
-        self.cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        return self.cursor.fetchone()
+        with self.lock:
+            self.cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
+            return self.cursor.fetchone()
 
     def update_user_host(self, username, new_host):
-        self.cursor.execute('UPDATE users SET host = ? WHERE username = ?', (new_host, username))
-        self.conn.commit()
+        with self.lock:
+            self.cursor.execute('UPDATE users SET host = ? WHERE username = ?', (new_host, username))
+            self.conn.commit()
 
     def delete_user(self, username):
-        self.cursor.execute('DELETE FROM users WHERE username = ?', (username,))
-        self.conn.commit()
+        with self.lock:
+            self.cursor.execute('DELETE FROM users WHERE username = ?', (username,))
+            self.conn.commit()
+
+    def add_subscription(self, user_id):
+        with self.lock:
+            self.cursor.execute('INSERT OR IGNORE INTO subscriptions (user_id) VALUES (?)', (user_id,))
+            self.conn.commit()
+
+    def remove_subscription(self, user_id):
+        with self.lock:
+            self.cursor.execute('DELETE FROM subscriptions WHERE user_id = ?', (user_id,))
+            self.conn.commit()
+
+    def get_subscribed_users(self):
+        with self.lock:
+            self.cursor.execute('''
+                SELECT users.* FROM users
+                JOIN subscriptions ON subscriptions.user_id = users.user_id
+            ''')
+            return self.cursor.fetchall()
 
     def insert_metric(self, user_id, experiment_id, section, metric_name, iteration, value):
-        self.cursor.execute('''
-            INSERT or REPLACE INTO metrics (user_id, experiment_id, section, metric_name, iteration, value)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (user_id, experiment_id, section, metric_name, iteration, value))
-        self.conn.commit()
-
-    def get_metrics_by_section(self, experiment_id, section):
-        self.cursor.execute('''
-            SELECT * FROM metrics 
-            WHERE experiment_id = ? AND section = ?
-        ''', (experiment_id, section))
-        return self.cursor.fetchall()
+        with self.lock:
+            self.cursor.execute('''
+                INSERT or REPLACE INTO metrics (user_id, experiment_id, section, metric_name, iteration, value)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (user_id, experiment_id, section, metric_name, iteration, value))
+            self.conn.commit()
+
+    def insert_metrics(self, metrics):
+        with self.lock:
+            with self.conn:
+                self.cursor.executemany('''
+                    INSERT or REPLACE INTO metrics (user_id, experiment_id, section, metric_name, iteration, value)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', metrics)
+
+    def get_metrics_by_section(self, user_id, experiment_id, section):
+        with self.lock:
+            self.cursor.execute('''
+                SELECT * FROM metrics 
+                WHERE user_id = ? AND experiment_id = ? AND section = ?
+            ''', (user_id, experiment_id, section))
+            return self.cursor.fetchall()
+
+    def get_metric_points(self, user_id, experiment_id, section, since_iteration=-1):
+        with self.lock:
+            self.cursor.execute('''
+                SELECT metric_name, iteration, value FROM metrics
+                WHERE user_id = ? AND experiment_id = ? AND section = ? AND iteration >= ?
+                ORDER BY iteration
+            ''', (user_id, experiment_id, section, since_iteration))
+            return self.cursor.fetchall()
     
+    def load_experiments(self):
+        # The experiments table is small and read on every delivery, so it is kept
+        # in memory and written back by flush_experiments
+        with self.lock:
+            self.cursor.execute('SELECT * FROM experiments')
+            self.experiments = {(row[0], row[1]): row for row in self.cursor.fetchall()}
+            self.dirty_experiments = set()
+
+    def reload_experiments(self, user_ids):
+        # Rows of users handed over by another process replace whatever this
+        # process cached for them earlier
+        user_ids = set(user_ids)
+        with self.lock:
+            for key in [key for key in self.experiments if key[0] in user_ids]:
+                self.experiments.pop(key)
+                self.dirty_experiments.discard(key)
+            for user_id in user_ids:
+                self.cursor.execute('SELECT * FROM experiments WHERE user_id = ?', (user_id,))
+                for row in self.cursor.fetchall():
+                    self.experiments[(row[0], row[1])] = row
+
     def store_experiment_info(self, user_id, experiment_id, experiment_name, last_iteration, text_msg_id, train_msg_id, val_msg_id):
-        self.cursor.execute('''
-            INSERT OR REPLACE INTO experiments (user_id, experiment_id, experiment_name, last_iteration, text_msg_id, train_msg_id, val_msg_id)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (user_id, experiment_id, experiment_name, last_iteration, text_msg_id, train_msg_id, val_msg_id))
-        self.conn.commit()
+        with self.lock:
+            self.experiments[(user_id, experiment_id)] = (user_id, experiment_id, experiment_name, last_iteration,
+                                                          text_msg_id, train_msg_id, val_msg_id)
+            self.dirty_experiments.add((user_id, experiment_id))
 
     def get_experiment_info(self, user_id, experiment_id):
-        self.cursor.execute('SELECT * FROM experiments WHERE user_id = ? AND experiment_id = ?', 
-                            (user_id, experiment_id))
-        return self.cursor.fetchone()
+        with self.lock:
+            return self.experiments.get((user_id, experiment_id))
+
+    def get_experiment_ids(self, user_id):
+        # Stored rows only; experiments first seen by this process are tracked
+        # by their client
+        with self.lock:
+            self.cursor.execute('SELECT experiment_id FROM experiments WHERE user_id = ?', (user_id,))
+            return [row[0] for row in self.cursor.fetchall()]
+
+    def flush_experiments(self):
+        with self.lock:
+            if not self.dirty_experiments:
+                return 0
+            rows = [self.experiments[key] for key in self.dirty_experiments if key in self.experiments]
+            with self.conn:
+                self.cursor.executemany('''
+                    INSERT OR REPLACE INTO experiments (user_id, experiment_id, experiment_name, last_iteration, text_msg_id, train_msg_id, val_msg_id)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', rows)
+            self.dirty_experiments.clear()
+            return len(rows)
     
+    def store_plot_hash(self, user_id, message_id, plot_hash):
+        with self.lock:
+            self.cursor.execute('''
+                INSERT OR REPLACE INTO plot_hashes (user_id, message_id, plot_hash)
+                VALUES (?, ?, ?)
+            ''', (user_id, message_id, plot_hash))
+            self.conn.commit()
+
+    def get_plot_hash(self, user_id, message_id):
+        with self.lock:
+            self.cursor.execute('SELECT plot_hash FROM plot_hashes WHERE user_id = ? AND message_id = ?',
+                                (user_id, message_id))
+            row = self.cursor.fetchone()
+            return row[0] if row is not None else None
+
+    def mark_experiment_finished(self, user_id, experiment_id, finished_at):
+        with self.lock:
+            self.cursor.execute('''
+                INSERT OR IGNORE INTO finished_experiments (user_id, experiment_id, finished_at)
+                VALUES (?, ?, ?)
+            ''', (user_id, experiment_id, finished_at))
+            self.conn.commit()
+
+    def unmark_experiment_finished(self, user_id, experiment_id):
+        # The archive of a resumed experiment is restored into the metrics table
+        # by the caller before it is dropped here
+        with self.lock:
+            with self.conn:
+                self.cursor.execute('DELETE FROM finished_experiments WHERE user_id = ? AND experiment_id = ?',
+                                    (user_id, experiment_id))
+                self.cursor.execute('DELETE FROM metric_archives WHERE user_id = ? AND experiment_id = ?',
+                                    (user_id, experiment_id))
+
+    def get_finished_experiments(self, compacted):
+        with self.lock:
+            self.cursor.execute('SELECT user_id, experiment_id, finished_at FROM finished_experiments '
+                                'WHERE compacted = ?', (compacted,))
+            return self.cursor.fetchall()
+
+    def store_metric_archives(self, user_id, experiment_id, archives):
+        with self.lock:
+            with self.conn:
+                self.cursor.executemany('''
+                    INSERT OR REPLACE INTO metric_archives (user_id, experiment_id, section, points, data)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', [(user_id, experiment_id, section, points, data) for section, points, data in archives])
+                self.cursor.execute('''
+                    UPDATE finished_experiments SET compacted = ?
+                    WHERE user_id = ? AND experiment_id = ?
+                ''', (COMPACTED, user_id, experiment_id))
+
+    def get_metric_archives(self, user_id, experiment_id):
+        with self.lock:
+            self.cursor.execute('SELECT section, data FROM metric_archives '
+                                'WHERE user_id = ? AND experiment_id = ?',
+                                (user_id, experiment_id))
+            return self.cursor.fetchall()
+
+    def delete_experiment_data(self, user_id, experiment_id):
+        # Raw metric rows and message bookkeeping go; the compacted archive stays
+        # until delete_metric_archives
+        with self.lock:
+            self.flush_experiments()
+            self.experiments.pop((user_id, experiment_id), None)
+            with self.conn:
+                self.cursor.execute('''
+                    DELETE FROM plot_hashes WHERE user_id = ? AND message_id IN (
+                        SELECT train_msg_id FROM experiments WHERE user_id = ? AND experiment_id = ?
+                        UNION SELECT val_msg_id FROM experiments WHERE user_id = ? AND experiment_id = ?
+                    )
+                ''', (user_id, user_id, experiment_id, user_id, experiment_id))
+                self.cursor.execute('DELETE FROM metrics WHERE user_id = ? AND experiment_id = ?',
+                                    (user_id, experiment_id))
+                self.cursor.execute('DELETE FROM experiments WHERE user_id = ? AND experiment_id = ?',
+                                    (user_id, experiment_id))
+                self.cursor.execute('UPDATE finished_experiments SET compacted = ? '
+                                    'WHERE user_id = ? AND experiment_id = ?',
+                                    (EXPIRED, user_id, experiment_id))
+
+    def delete_metric_archives(self, user_id, experiment_id):
+        with self.lock:
+            with self.conn:
+                self.cursor.execute('DELETE FROM metric_archives WHERE user_id = ? AND experiment_id = ?',
+                                    (user_id, experiment_id))
+                self.cursor.execute('DELETE FROM finished_experiments WHERE user_id = ? AND experiment_id = ?',
+                                    (user_id, experiment_id))
+
+    def enable_incremental_vacuum(self):
+        # Run once at startup, before any worker uses the database: converting
+        # an existing file rewrites it and holds the lock for the whole time
+        with self.lock:
+            self.cursor.execute('PRAGMA auto_vacuum')
+            if self.cursor.fetchone()[0] != 2:
+                # Switching an existing database needs one full VACUUM
+                self.cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                self.cursor.execute('VACUUM')
+
+    def incremental_vacuum(self, pages=1000):
+        with self.lock:
+            self.cursor.execute(f'PRAGMA incremental_vacuum({int(pages)})')
+            self.cursor.fetchall()
+
+    def set_delivery_mode(self, user_id, delivery_mode):
+        with self.lock:
+            self.cursor.execute('''
+                INSERT INTO user_settings (user_id, delivery_mode) VALUES (?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET delivery_mode = excluded.delivery_mode
+            ''', (user_id, delivery_mode))
+            self.conn.commit()
+
+    def get_delivery_mode(self, user_id):
+        with self.lock:
+            self.cursor.execute('SELECT delivery_mode FROM user_settings WHERE user_id = ?', (user_id,))
+            row = self.cursor.fetchone()
+            return row[0] if row is not None else None
+
+    def add_alert_rule(self, user_id, section, metric_name, kind, threshold, window):
+        with self.lock:
+            self.cursor.execute('''
+                INSERT INTO alert_rules (user_id, section, metric_name, kind, threshold, window)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (user_id, section, metric_name, kind, threshold, window))
+            self.conn.commit()
+            return self.cursor.lastrowid
+
+    def get_alert_rules(self, user_id):
+        with self.lock:
+            self.cursor.execute('SELECT * FROM alert_rules WHERE user_id = ? ORDER BY rule_id', (user_id,))
+            return self.cursor.fetchall()
+
+    def delete_alert_rule(self, user_id, rule_id):
+        with self.lock:
+            self.cursor.execute('DELETE FROM alert_rules WHERE user_id = ? AND rule_id = ?', (user_id, rule_id))
+            self.conn.commit()
+            return self.cursor.rowcount > 0
+
     def close_connection(self):
-        self.conn.close()
+        with self.lock:
+            self.flush_experiments()
+            self.conn.close()
 
 if __name__ == "__main__":
     db = Database()
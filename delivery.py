@@ -0,0 +1,151 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from telebot.apihelper import ApiTelegramException
+
+from instrumentation import stats
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class Delivery:
+    def __init__(self, chat_id, key, action):
+        self.chat_id = chat_id
+        self.key = key
+        self.action = action
+        self.attempts = 0
+
+
+class DeliveryQueue:
+    def __init__(self, global_rate=25, chat_rate=1, chat_burst=3, workers=4, max_attempts=3):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_attempts = max_attempts
+
+        # key -> Delivery, in arrival order. A newer delivery for a key that is
+        # still waiting replaces the stale one in place
+        self.pending = OrderedDict()
+        self.condition = threading.Condition()
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}
+        self.blocked_until = {}
+        # One call in flight per chat keeps a chat's messages in order
+        self.busy_chats = set()
+        self.coalesced = 0
+
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f'delivery-{i}', daemon=True).start()
+
+    def enqueue(self, chat_id, key, action):
+        with self.condition:
+            if key in self.pending:
+                self.coalesced += 1
+                stats.increment("clearml_bot_deliveries_coalesced_total")
+            self.pending[key] = Delivery(chat_id, key, action)
+            self.condition.notify_all()
+
+    def wait_idle(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while self.pending or self.busy_chats:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def _requeue(self, delivery):
+        with self.condition:
+            # A newer delivery for the same key supersedes the failed one
+            if delivery.key not in self.pending:
+                self.pending[delivery.key] = delivery
+                self.condition.notify_all()
+
+    def _next_delivery(self, now):
+        wait = self.global_bucket.wait_time(now)
+        if wait > 0:
+            return None, wait
+
+        wait = None
+        for key, delivery in self.pending.items():
+            chat_id = delivery.chat_id
+            if chat_id in self.busy_chats:
+                continue
+
+            chat_wait = self.blocked_until.get(chat_id, 0) - now
+            if chat_wait <= 0:
+                bucket = self.chat_buckets.get(chat_id)
+                if bucket is None:
+                    bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+                chat_wait = bucket.wait_time(now)
+                if chat_wait <= 0:
+                    bucket.take(now)
+                    self.global_bucket.take(now)
+                    self.pending.pop(key)
+                    return delivery, None
+
+            wait = chat_wait if wait is None else min(wait, chat_wait)
+        return None, wait
+
+    def _worker(self):
+        while True:
+            with self.condition:
+                delivery, wait = self._next_delivery(time.monotonic())
+                while delivery is None:
+                    self.condition.wait(wait)
+                    delivery, wait = self._next_delivery(time.monotonic())
+                self.busy_chats.add(delivery.chat_id)
+
+            try:
+                self._deliver(delivery)
+            finally:
+                with self.condition:
+                    self.busy_chats.discard(delivery.chat_id)
+                    self.condition.notify_all()
+
+    def _deliver(self, delivery):
+        delivery.attempts += 1
+        try:
+            with stats.timed("telegram", user=delivery.chat_id, key=delivery.key):
+                delivery.action()
+            stats.increment("clearml_bot_telegram_calls_total")
+        except ApiTelegramException as e:
+            stats.increment("clearml_bot_telegram_errors_total", code=e.error_code)
+            if e.error_code == 429:
+                retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+                logging.warning(f'Telegram rate limit for chat {delivery.chat_id}, retrying in {retry_after}s')
+                with self.condition:
+                    self.blocked_until[delivery.chat_id] = time.monotonic() + retry_after
+                self._requeue(delivery)
+            elif 'message is not modified' in e.description:
+                pass
+            else:
+                logging.warning(f'Telegram rejected update {delivery.key}: {e.description}')
+        except Exception as e:
+            if delivery.attempts < self.max_attempts:
+                logging.warning(f'Delivery of {delivery.key} failed ({e}), retrying')
+                self._requeue(delivery)
+            else:
+                logging.error(f'Delivery of {delivery.key} failed after {delivery.attempts} attempts: {e}')
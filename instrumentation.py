@@ -0,0 +1,145 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{name}_bucket{_format_labels({**labels, "le": bound})} {cumulative}'
+        yield f'{name}_bucket{_format_labels({**labels, "le": "+Inf"})} {self.count}'
+        yield f'{name}_sum{_format_labels(labels)} {self.sum}'
+        yield f'{name}_count{_format_labels(labels)} {self.count}'
+
+
+class Metrics:
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        # Spans of the running update cycle, kept only while a trace is active
+        self.trace = None
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple((label, str(label_value)) for label, label_value in labels.items()))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple((label, str(label_value)) for label, label_value in labels.items()))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    @contextmanager
+    def timed(self, phase, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            self.observe('clearml_bot_phase_seconds', duration, phase=phase,
+                         **{name: value for name, value in labels.items() if name in ('host', 'user')})
+            if self.trace is not None:
+                with self.lock:
+                    if self.trace is not None:
+                        self.trace.append({
+                            'phase': phase,
+                            'thread': threading.current_thread().name,
+                            'start': round(start - self.trace_started, 4),
+                            'duration': round(duration, 4),
+                            **{name: str(value) for name, value in labels.items()}
+                        })
+
+    def start_trace(self):
+        with self.lock:
+            self.trace = []
+            self.trace_started = time.perf_counter()
+
+    def finish_trace(self):
+        with self.lock:
+            trace, self.trace = self.trace, None
+        return trace or []
+
+    def render(self):
+        lines = []
+        with self.lock:
+            last_name = None
+            for (name, labels), value in sorted(self.counters.items()):
+                if name != last_name:
+                    lines.append(f'# TYPE {name} counter')
+                    last_name = name
+                lines.append(f'{name}{_format_labels(dict(labels))} {value}')
+            for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                if name != last_name:
+                    lines.append(f'# TYPE {name} histogram')
+                    last_name = name
+                lines.extend(histogram.lines(name, dict(labels)))
+        return '\n'.join(lines) + '\n'
+
+
+stats = Metrics()
+
+
+def dump_slow_cycle(trace_dir, duration, spans):
+    os.makedirs(trace_dir, exist_ok=True)
+    path = os.path.join(trace_dir, f'cycle-{time.strftime("%Y%m%d-%H%M%S")}-{int(duration * 1000)}ms.json')
+    spans = sorted(spans, key=lambda span: span['duration'], reverse=True)
+    with open(path, 'w') as file:
+        json.dump({'duration': duration, 'spans': spans}, file, indent=2)
+    logging.warning(f'Slow update cycle ({duration:.2f}s), trace written to {path}')
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = stats.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, host='127.0.0.1'):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logging.info(f'Serving metrics on http://{host}:{port}/metrics')
+    return server
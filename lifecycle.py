@@ -0,0 +1,74 @@
+import logging
+import threading
+import time
+
+from database import COMPACTED, EXPIRED, RAW
+from instrumentation import stats
+
+
+class LifecycleManager:
+    def __init__(self, database, user_sessions, metrics_ttl=7 * 24 * 3600, archive_ttl=90 * 24 * 3600,
+                 idle_client_ttl=3600, vacuum_pages=1000, maintain_database=True):
+        self.database = database
+        self.user_sessions = user_sessions
+        # With several worker processes only the front process maintains the database
+        self.maintain_database = maintain_database
+        self.metrics_ttl = metrics_ttl
+        self.archive_ttl = archive_ttl
+        self.idle_client_ttl = idle_client_ttl
+        self.vacuum_pages = vacuum_pages
+        self.lock = threading.Lock()
+
+    def run(self):
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            with stats.timed("lifecycle"):
+                if self.maintain_database:
+                    self.compact_finished_experiments()
+                    self.delete_expired_experiments()
+                    self.delete_expired_archives()
+                self.release_idle_clients()
+                if self.maintain_database:
+                    self.vacuum()
+        except Exception as e:
+            logging.error(f'Lifecycle run failed: {e}')
+        finally:
+            self.lock.release()
+
+    def compact_finished_experiments(self):
+        from metric_store import SectionSeries
+
+        for user_id, experiment_id, _ in self.database.get_finished_experiments(RAW):
+            archives = []
+            for section in ("train", "val"):
+                section_series = SectionSeries()
+                section_series.merge(self.database.get_metric_points(user_id, experiment_id, section))
+                if len(section_series):
+                    archives.append((section, len(section_series), section_series.to_blob()))
+            self.database.store_metric_archives(user_id, experiment_id, archives)
+            stats.increment("clearml_bot_experiments_compacted_total")
+
+    def delete_expired_experiments(self):
+        expire_before = time.time() - self.metrics_ttl
+        for user_id, experiment_id, finished_at in self.database.get_finished_experiments(COMPACTED):
+            if finished_at < expire_before:
+                self.database.delete_experiment_data(user_id, experiment_id)
+                stats.increment("clearml_bot_experiments_expired_total")
+
+    def delete_expired_archives(self):
+        expire_before = time.time() - self.archive_ttl
+        for user_id, experiment_id, finished_at in self.database.get_finished_experiments(EXPIRED):
+            if finished_at < expire_before:
+                self.database.delete_metric_archives(user_id, experiment_id)
+                stats.increment("clearml_bot_archives_expired_total")
+
+    def release_idle_clients(self):
+        idle_before = time.time() - self.idle_client_ttl
+        for user_api_client in list(self.user_sessions.values()):
+            if not user_api_client.running_iterations and user_api_client.last_active < idle_before:
+                user_api_client.release()
+
+    def vacuum(self):
+        # Takes effect once enable_incremental_vacuum has run at startup
+        self.database.incremental_vacuum(self.vacuum_pages)
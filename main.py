@@ -1,35 +1,74 @@
 import json
 import time
-import schedule
 import threading
 
 from bot import ClearMLBot
 from database import Database
+from instrumentation import start_metrics_server
+from sharding import run_sharded
+
+
+def run_update_loop(bot, config):
+    lifecycle_interval = config.get("LIFECYCLE_INTERVAL", 3600)
+    next_lifecycle_run = time.monotonic() + lifecycle_interval
+    flush_interval = config.get("FLUSH_INTERVAL", 5)
+    next_flush = time.monotonic() + flush_interval
+
+    # Each user is polled when the scheduler expects a new iteration. Cycles run
+    # off this thread; while one overruns, due users wait for it, not queue up
+    while True:
+        try:
+            wait = bot.scheduler.seconds_until_due()
+            if wait == 0:
+                if bot.update_engine.is_running():
+                    bot.update_engine.record_overrun()
+                else:
+                    threading.Thread(target=bot.send_due_updates, daemon=True).start()
+            if time.monotonic() >= next_flush:
+                next_flush = time.monotonic() + flush_interval
+                bot.flush_experiments()
+            if time.monotonic() >= next_lifecycle_run:
+                next_lifecycle_run = time.monotonic() + lifecycle_interval
+                threading.Thread(target=bot.lifecycle.run, daemon=True).start()
+            time.sleep(min(wait or 1, 1))
+        except Exception as e:
+            print(f'An error occured in the update loop: {e}')
 
 
 def main():
-    database = Database()
     with open('config.json', 'r') as file:
         config = json.load(file)
-    
+
     if config["TG_TOKEN"] == "TG_TOKEN":
         print("Please specify TG_TOKEN in config.json")
         exit(1)
 
-    bot = ClearMLBot(config["TG_TOKEN"], database)
+    if config.get("SHARD_WORKERS"):
+        run_sharded(config)
+        return
 
-    schedule.every(5).seconds.do(bot.send_updates_to_users)
+    database = Database()
+    database.enable_incremental_vacuum()
+    bot = ClearMLBot(config["TG_TOKEN"], database, config)
+    bot.restore_subscriptions()
 
-    bot_thread = threading.Thread(target=bot.polling)
-    bot_thread.daemon = True
-    bot_thread.start()
+    if config.get("METRICS_PORT"):
+        start_metrics_server(config["METRICS_PORT"], config.get("METRICS_HOST", "127.0.0.1"))
 
-    while True:
-        try:
-            schedule.run_pending()
-            time.sleep(1)
-        except Exception as e:
-            print(f'An error occured in schedule.run_pending: {e}')
+    if config.get("WEBHOOK_URL"):
+        bot.start_webhook(
+            config["WEBHOOK_URL"],
+            host=config.get("WEBHOOK_HOST", "0.0.0.0"),
+            port=config.get("WEBHOOK_PORT", 8443),
+            secret_token=config.get("WEBHOOK_SECRET"),
+            max_workers=config.get("HANDLER_WORKERS", 8)
+        )
+    else:
+        bot_thread = threading.Thread(target=bot.polling)
+        bot_thread.daemon = True
+        bot_thread.start()
+
+    run_update_loop(bot, config)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,96 @@
+import json
+import zlib
+
+import numpy as np
+
+
+class SectionSeries:
+    # All points of one experiment section as parallel columns ordered by
+    # iteration. Metric names are stored once and referenced by small codes.
+    def __init__(self):
+        self.names = []
+        self.codes_by_name = {}
+        self.codes = np.empty(0, dtype=np.int16)
+        self.iterations = np.empty(0, dtype=np.int64)
+        self.values = np.empty(0, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.iterations)
+
+    @property
+    def last_iteration(self):
+        return int(self.iterations[-1]) if len(self.iterations) else -1
+
+    def metric_names(self):
+        return set(self.names[code] for code in np.unique(self.codes))
+
+    def _encode(self, names):
+        for name in set(names):
+            if name not in self.codes_by_name:
+                self.codes_by_name[name] = len(self.names)
+                self.names.append(name)
+        return np.fromiter(map(self.codes_by_name.__getitem__, names), dtype=np.int16, count=len(names))
+
+    def merge(self, points):
+        # points are (metric_name, iteration, value) ordered by iteration and cover
+        # every stored point from their first iteration on, so older points from
+        # that iteration are replaced rather than duplicated
+        if not points:
+            return
+        codes = self._encode([point[0] for point in points])
+        iterations = np.fromiter((point[1] for point in points), dtype=np.int64, count=len(points))
+        values = np.fromiter((point[2] for point in points), dtype=np.float64, count=len(points))
+
+        keep = np.searchsorted(self.iterations, iterations[0], side='left')
+        self.codes = np.concatenate((self.codes[:keep], codes))
+        self.iterations = np.concatenate((self.iterations[:keep], iterations))
+        self.values = np.concatenate((self.values[:keep], values))
+
+    def series(self):
+        # One stable sort by metric code, then split where the code changes;
+        # each metric's points stay in iteration order
+        if not len(self.codes):
+            return []
+        order = np.argsort(self.codes, kind='stable')
+        codes = self.codes[order]
+        boundaries = np.flatnonzero(np.diff(codes)) + 1
+        starts = np.concatenate(([0], boundaries))
+        grouped = zip(
+            starts,
+            np.split(self.iterations[order], boundaries),
+            np.split(self.values[order], boundaries)
+        )
+        series = [(self.names[codes[start]], iterations, values) for start, iterations, values in grouped]
+        return sorted(series, key=lambda item: item[0])
+
+    def to_blob(self):
+        # Columns are stored back to back after a JSON header; iterations are
+        # delta encoded since they only grow, which zlib compresses well
+        header = json.dumps({"names": self.names, "points": len(self)}).encode()
+        iteration_deltas = np.diff(self.iterations, prepend=0)
+        payload = b''.join((
+            len(header).to_bytes(4, 'little'),
+            header,
+            self.codes.astype('<i2').tobytes(),
+            iteration_deltas.astype('<i8').tobytes(),
+            self.values.astype('<f8').tobytes()
+        ))
+        return zlib.compress(payload, 6)
+
+    @classmethod
+    def from_blob(cls, blob):
+        payload = zlib.decompress(blob)
+        header_size = int.from_bytes(payload[:4], 'little')
+        header = json.loads(payload[4:4 + header_size])
+        points = header["points"]
+
+        section_series = cls()
+        section_series.names = header["names"]
+        section_series.codes_by_name = {name: code for code, name in enumerate(section_series.names)}
+        offset = 4 + header_size
+        section_series.codes = np.frombuffer(payload, dtype='<i2', count=points, offset=offset).astype(np.int16)
+        offset += points * 2
+        section_series.iterations = np.cumsum(np.frombuffer(payload, dtype='<i8', count=points, offset=offset))
+        offset += points * 8
+        section_series.values = np.frombuffer(payload, dtype='<f8', count=points, offset=offset).astype(np.float64)
+        return section_series
@@ -0,0 +1,87 @@
+import logging
+import threading
+import time
+
+
+class Snapshot:
+    __slots__ = ("running_tasks", "polled_at", "pages")
+
+    def __init__(self, running_tasks):
+        self.running_tasks = running_tasks
+        self.polled_at = time.monotonic()
+        # Views built from this snapshot by the bot, e.g. /experiments pages
+        self.pages = None
+
+
+class PollGroup:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cycle = -1
+        self.snapshot = None
+        self.error = None
+        self.subscribers = set()
+
+    def poll(self, api_client):
+        try:
+            self.snapshot = Snapshot(api_client.get_running_tasks())
+            self.error = None
+        except Exception as e:
+            self.snapshot = None
+            self.error = e
+
+
+class SharedPoller:
+    def __init__(self):
+        self.cycle = 0
+        self.groups = {}
+        self.groups_lock = threading.Lock()
+
+    def start_cycle(self):
+        self.cycle += 1
+
+    def _get_group(self, group_key):
+        with self.groups_lock:
+            group = self.groups.get(group_key)
+            if group is None:
+                group = self.groups[group_key] = PollGroup()
+            return group
+
+    def get_running_tasks(self, chat_id, api_client):
+        group = self._get_group(api_client.get_poll_group())
+        group.subscribers.add(chat_id)
+
+        # The first subscriber of a group to get here in a cycle does the request,
+        # the rest of the group waits for it and reuses the result (or the error)
+        with group.lock:
+            if group.cycle != self.cycle:
+                group.cycle = self.cycle
+                group.poll(api_client)
+                logging.info(f'Polled {api_client.host} for {len(group.subscribers)} subscribers')
+            snapshot, error = group.snapshot, group.error
+
+        if error is not None:
+            raise error
+        return snapshot.running_tasks
+
+    def get_snapshot(self, chat_id, api_client, max_age):
+        # Commands reuse the group's last poll while it is fresh, whether it came
+        # from an update cycle or from another command
+        group = self._get_group(api_client.get_poll_group())
+        group.subscribers.add(chat_id)
+
+        with group.lock:
+            snapshot = group.snapshot
+            if snapshot is None or time.monotonic() - snapshot.polled_at > max_age:
+                group.poll(api_client)
+            snapshot, error = group.snapshot, group.error
+
+        if error is not None:
+            raise error
+        return snapshot
+
+    def remove_subscriber(self, chat_id):
+        with self.groups_lock:
+            for group_key, group in list(self.groups.items()):
+                group.subscribers.discard(chat_id)
+                if not group.subscribers:
+                    self.groups.pop(group_key)
@@ -0,0 +1,233 @@
+import hashlib
+import io
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+DEFAULT_MAX_POINTS = 1000
+MARKER_MAX_POINTS = 50
+# Inches and dots per inch of a dashboard image
+DASHBOARD_SIZE = (8, 3.5)
+DASHBOARD_DPI = 72
+SPARKLINE_WIDTH = 20
+SPARK_BARS = '▁▂▃▄▅▆▇█'
+
+
+def downsample(iterations, values, max_points=DEFAULT_MAX_POINTS):
+    # Min/max bucketing: each bucket keeps its lowest and highest value, plus the
+    # first and last point of the series, so spikes and the final value survive
+    import numpy as np
+
+    num_points = len(iterations)
+    if num_points <= max_points:
+        return iterations, values
+
+    num_buckets = max(1, (max_points - 2) // 2)
+    edges = np.linspace(0, num_points, num_buckets + 1).astype(np.int64)
+    bucket_ids = np.repeat(np.arange(num_buckets), np.diff(edges))
+    order = np.lexsort((values, bucket_ids))
+    keep = np.unique(np.concatenate((
+        order[edges[:-1]],
+        order[edges[1:] - 1],
+        [0, num_points - 1]
+    )))
+    return iterations[keep], values[keep]
+
+
+def _draw_section(ax, series, title, color_palette, legend_columns=4, font_size=None):
+    import numpy as np
+    from matplotlib.ticker import MaxNLocator
+
+    legend_labels = []
+    for metric_name, color_index, iterations, values in series:
+        ax.plot(
+            iterations,
+            values,
+            marker='o' if len(iterations) <= MARKER_MAX_POINTS else None,
+            linestyle='-',
+            label=f'{metric_name}',
+            color=color_palette(color_index)
+        )
+        legend_labels.append(f'{metric_name}: {round(float(values[-1]), 3)}')
+
+    ax.set_title(title, fontsize=font_size)
+    ax.set_xlabel('Iterations', fontsize=font_size)
+    ax.set_ylabel('Values', fontsize=font_size)
+    # The number of ticks follows the axis width, not the number of iterations
+    ax.xaxis.set_major_locator(MaxNLocator(nbins='auto', integer=True))
+    ax.set_yticks(np.arange(0, 1.01, 0.1))
+    ax.set_yticks(np.arange(0, 1.0, 0.05), minor=True)
+    ax.tick_params(labelsize=font_size)
+    ax.grid(axis='y', which='both')
+    ax.set_ylim([-0.05, 1.05])
+    ax.legend(labels=legend_labels, loc='upper center', fontsize=font_size,
+              bbox_to_anchor=(0.5, -0.15), shadow=True, ncol=legend_columns)
+
+
+def render_plot(series, metric_type, experiment_name, num_colors):
+    # matplotlib is only loaded by the processes that actually render
+    from matplotlib import colormaps
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    # Figure + Agg canvas instead of pyplot: no global state, safe in any thread or process
+    color_palette = colormaps['tab10'].resampled(max(num_colors, 1))
+    figure = Figure(figsize=(10, 6))
+    FigureCanvasAgg(figure)
+    ax = figure.add_subplot()
+    _draw_section(ax, series, f"{metric_type} metrics for {experiment_name}", color_palette)
+    figure.tight_layout()
+    img = io.BytesIO()
+    figure.savefig(img, format='png')
+    return img.getvalue()
+
+
+def render_dashboard(panels, experiment_name, num_colors, figsize=DASHBOARD_SIZE, dpi=DASHBOARD_DPI):
+    # All sections of an experiment side by side in one small image; panels are
+    # (metric_type, series) and share one color per metric
+    from matplotlib import colormaps
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    color_palette = colormaps['tab10'].resampled(max(num_colors, 1))
+    figure = Figure(figsize=figsize, dpi=dpi)
+    FigureCanvasAgg(figure)
+    axes = figure.subplots(1, len(panels), squeeze=False)[0]
+    for ax, (metric_type, series) in zip(axes, panels):
+        _draw_section(ax, series, metric_type, color_palette, legend_columns=2, font_size='x-small')
+    figure.suptitle(experiment_name, fontsize='small')
+    figure.tight_layout()
+    img = io.BytesIO()
+    figure.savefig(img, format='png', dpi=dpi)
+    return img.getvalue()
+
+
+def sparkline(values, width=SPARKLINE_WIDTH):
+    # The last value of each of up to width buckets, scaled to eight bar heights
+    import numpy as np
+
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) > width:
+        values = values[np.linspace(0, len(values), width + 1).astype(np.int64)[1:] - 1]
+    finite = values[np.isfinite(values)]
+    if not len(finite):
+        return ''
+    low, high = finite.min(), finite.max()
+    scale = (len(SPARK_BARS) - 1) / (high - low) if high > low else 0
+    return ''.join(SPARK_BARS[int((value - low) * scale)] if np.isfinite(value) else ' ' for value in values)
+
+
+def plot_hash(series, metric_type, experiment_name, num_colors, extra=''):
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f'{metric_type}\0{experiment_name}\0{num_colors}\0{extra}'.encode())
+    for metric_name, color_index, iterations, values in series:
+        digest.update(f'\0{metric_name}\0{color_index}\0'.encode())
+        digest.update(iterations.tobytes())
+        digest.update(values.tobytes())
+    return digest.hexdigest()
+
+
+class PlotCache:
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            future = self.entries.get(key)
+            if future is not None:
+                self.entries.move_to_end(key)
+            return future
+
+    def put(self, key, future):
+        with self.lock:
+            self.entries[key] = future
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def discard(self, key, future):
+        with self.lock:
+            if self.entries.get(key) is future:
+                self.entries.pop(key)
+
+
+def _exit_with_parent():
+    # Runs in each render process: one whose bot process was killed would
+    # otherwise keep running on its own
+    parent = multiprocessing.parent_process()
+
+    def watch():
+        parent.join()
+        os._exit(0)
+
+    threading.Thread(target=watch, name='parent-watch', daemon=True).start()
+
+
+class PlotRenderer:
+    def __init__(self, max_workers=None, cache_size=256, max_points=DEFAULT_MAX_POINTS,
+                 dashboard_size=DASHBOARD_SIZE, dashboard_dpi=DASHBOARD_DPI, sparkline_width=SPARKLINE_WIDTH):
+        self.max_workers = max_workers
+        self.max_points = max_points
+        self.dashboard_size = tuple(dashboard_size)
+        self.dashboard_dpi = dashboard_dpi
+        self.sparkline_width = sparkline_width
+        self.cache = PlotCache(cache_size)
+        self.executor = self._create_executor()
+
+    def _create_executor(self):
+        # spawn: forking a process that already runs update and polling threads is unsafe
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_exit_with_parent
+        )
+
+    def submit(self, series, metric_type, experiment_name, num_colors, key=None):
+        return self._submit(render_plot, (series, metric_type, experiment_name, num_colors), key)
+
+    def submit_dashboard(self, panels, experiment_name, num_colors, figsize=DASHBOARD_SIZE, dpi=DASHBOARD_DPI,
+                         key=None):
+        return self._submit(render_dashboard, (panels, experiment_name, num_colors, figsize, dpi), key)
+
+    def _submit(self, render, args, key):
+        # Identical charts (e.g. teammates watching the same run) are rendered once;
+        # the cache holds futures so concurrent requests for one chart share a render
+        if key is not None:
+            future = self.cache.get(key)
+            if future is not None:
+                return future
+
+        try:
+            future = self.executor.submit(render, *args)
+        except BrokenProcessPool:
+            print('Plot render pool is broken, restarting it')
+            self.executor = self._create_executor()
+            future = self.executor.submit(render, *args)
+
+        if key is not None:
+            self.cache.put(key, future)
+
+            def forget_failed(done):
+                if done.exception() is not None:
+                    self.cache.discard(key, done)
+
+            future.add_done_callback(forget_failed)
+        return future
+
+    def shutdown(self, wait=False):
+        self.executor.shutdown(wait=wait, cancel_futures=True)
+
+
+def render_inline(render, *args):
+    future = Future()
+    try:
+        future.set_result(render(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
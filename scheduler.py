@@ -0,0 +1,145 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+class ExperimentCadence:
+    def __init__(self, iteration, now):
+        self.iteration = iteration
+        self.changed_at = now
+        self.seconds_per_iteration = None
+
+    def observe(self, iteration, now, smoothing):
+        if iteration == self.iteration:
+            return
+        if iteration > self.iteration:
+            sample = (now - self.changed_at) / (iteration - self.iteration)
+            if self.seconds_per_iteration is None:
+                self.seconds_per_iteration = sample
+            else:
+                self.seconds_per_iteration += smoothing * (sample - self.seconds_per_iteration)
+        self.iteration = iteration
+        self.changed_at = now
+
+
+class AdaptiveScheduler:
+    def __init__(self, min_interval=5, max_interval=60, max_idle_interval=300,
+                 max_host_backoff=600, smoothing=0.3):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_idle_interval = max_idle_interval
+        self.max_host_backoff = max_host_backoff
+        self.smoothing = smoothing
+
+        # Heap of (due time, seq, chat_id); entries whose due time no longer
+        # matches due_at are stale and dropped when popped
+        self.heap = []
+        self.seq = itertools.count()
+        self.due_at = {}
+        self.hosts = {}
+        self.cadences = {}
+        self.idle_intervals = {}
+        self.host_failures = {}
+        self.host_blocked_until = {}
+        self.lock = threading.Lock()
+
+    def _schedule(self, chat_id, due):
+        self.due_at[chat_id] = due
+        heapq.heappush(self.heap, (due, next(self.seq), chat_id))
+
+    def add_user(self, chat_id, host):
+        with self.lock:
+            self.hosts[chat_id] = host
+            self._schedule(chat_id, time.monotonic())
+
+    def remove_user(self, chat_id):
+        with self.lock:
+            self.hosts.pop(chat_id, None)
+            self.due_at.pop(chat_id, None)
+            self.idle_intervals.pop(chat_id, None)
+            for key in [key for key in self.cadences if key[0] == chat_id]:
+                self.cadences.pop(key)
+
+    def pop_due(self):
+        now = time.monotonic()
+        due_users = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                due, _, chat_id = heapq.heappop(self.heap)
+                if self.due_at.get(chat_id) != due:
+                    continue
+                host = self.hosts[chat_id]
+                blocked_until = self.host_blocked_until.get(host, 0)
+                if blocked_until > now:
+                    self._schedule(chat_id, blocked_until)
+                    continue
+                # Fallback in case the update is skipped and never reports back
+                self._schedule(chat_id, now + self.max_interval)
+                due_users.append((chat_id, host))
+        return due_users
+
+    def seconds_until_due(self):
+        with self.lock:
+            while self.heap and self.due_at.get(self.heap[0][2]) != self.heap[0][0]:
+                heapq.heappop(self.heap)
+            if not self.heap:
+                return None
+            return max(0, self.heap[0][0] - time.monotonic())
+
+    def record_poll(self, chat_id, running_iterations):
+        now = time.monotonic()
+        with self.lock:
+            if chat_id not in self.hosts:
+                return
+            host = self.hosts[chat_id]
+            self.host_failures.pop(host, None)
+            self.host_blocked_until.pop(host, None)
+
+            for key in [key for key in self.cadences if key[0] == chat_id and key[1] not in running_iterations]:
+                self.cadences.pop(key)
+
+            if not running_iterations:
+                interval = min(self.idle_intervals.get(chat_id, self.min_interval / 2) * 2, self.max_idle_interval)
+                self.idle_intervals[chat_id] = interval
+                self._schedule(chat_id, now + interval)
+                return
+            self.idle_intervals.pop(chat_id, None)
+
+            next_due = now + self.max_interval
+            for experiment_id, iteration in running_iterations.items():
+                cadence = self.cadences.get((chat_id, experiment_id))
+                if cadence is None:
+                    self.cadences[(chat_id, experiment_id)] = ExperimentCadence(iteration, now)
+                    next_due = min(next_due, now + self.min_interval)
+                    continue
+                cadence.observe(iteration, now, self.smoothing)
+                if cadence.seconds_per_iteration is None:
+                    next_due = min(next_due, now + self.min_interval)
+                    continue
+                expected = cadence.changed_at + cadence.seconds_per_iteration
+                if expected <= now:
+                    # Late iteration: keep checking, but not faster than a quarter of the cadence
+                    expected = now + cadence.seconds_per_iteration / 4
+                next_due = min(next_due, expected)
+
+            self._schedule(chat_id, max(next_due, now + self.min_interval))
+
+    def record_error(self, chat_id):
+        now = time.monotonic()
+        with self.lock:
+            host = self.hosts.get(chat_id)
+            if host is None:
+                return
+            # Users sharing a host fail together; count that as one failure
+            blocked_until = self.host_blocked_until.get(host, 0)
+            if blocked_until > now:
+                self._schedule(chat_id, blocked_until)
+                return
+            failures = self.host_failures.get(host, 0) + 1
+            self.host_failures[host] = failures
+            backoff = min(self.min_interval * 2 ** failures, self.max_host_backoff)
+            self.host_blocked_until[host] = now + backoff
+            self._schedule(chat_id, now + backoff)
+        logging.warning(f'Host {host} failed {failures} times in a row, backing off for {backoff}s')
@@ -0,0 +1,146 @@
+import base64
+import json
+import logging
+import threading
+import time
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from instrumentation import stats
+
+# Tokens without a readable expiry are renewed after this many seconds
+DEFAULT_TOKEN_TTL = 3600
+
+
+def _token_expiry(token):
+    # ClearML tokens are JWTs; only the expiry is read, the signature is the server's business
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return time.time() + DEFAULT_TOKEN_TTL
+
+
+class HostConnections:
+    # One keep-alive connection pool per ClearML server, shared by every
+    # credential pair on it, with a cap on requests in flight
+    def __init__(self, host, max_requests, timeout):
+        self.host = host.rstrip('/')
+        self.timeout = timeout
+        self.http = requests.Session()
+        # Requests are authenticated by their token only; a cookie set for one
+        # credential pair must not be sent with another's requests
+        self.http.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_requests)
+        self.http.mount('http://', adapter)
+        self.http.mount('https://', adapter)
+        self.slots = threading.BoundedSemaphore(max_requests)
+
+    def request(self, method, service, action, **kwargs):
+        with self.slots:
+            return self.http.request(method, f'{self.host}/{service}.{action}', timeout=self.timeout, **kwargs)
+
+
+class PooledSession:
+    # Drop-in for the part of clearml's Session the bot uses: send_request
+    # returns a requests.Response, logging in and refreshing the token as needed
+    def __init__(self, pool, connections, api_key, secret_key):
+        self.pool = pool
+        self.connections = connections
+        self.api_key = api_key
+        self.secret_key = secret_key
+        self.token = None
+        self.expires_at = 0
+        self.logged_in_at = 0
+        self.last_used = 0
+        # Clients holding this session; it leaves the pool when the last one releases it
+        self.users = 0
+        self.lock = threading.Lock()
+
+    def login(self):
+        response = self.connections.request('get', 'auth', 'login',
+                                            auth=(self.api_key, self.secret_key))
+        response.raise_for_status()
+        token = response.json()['data']['token']
+        stats.increment("clearml_bot_clearml_logins_total", host=self.connections.host)
+        self.token, self.expires_at = token, _token_expiry(token)
+        self.logged_in_at = time.time()
+        return token
+
+    def get_token(self, refresh=False):
+        with self.lock:
+            if refresh or self.token is None or self.expires_at - time.time() < self.pool.refresh_margin:
+                return self.login()
+            return self.token
+
+    def send_request(self, service, action, method='post', json=None, params=None, headers=None):
+        self.last_used = time.time()
+        headers = dict(headers or {})
+        headers['Authorization'] = f'Bearer {self.get_token()}'
+        response = self.connections.request(method, service, action, json=json, params=params, headers=headers)
+        if response.status_code == 401:
+            # The server may have revoked the token before its expiry
+            headers['Authorization'] = f'Bearer {self.get_token(refresh=True)}'
+            response = self.connections.request(method, service, action, json=json, params=params,
+                                                headers=headers)
+        return response
+
+
+class SessionPool:
+    def __init__(self, max_requests_per_host=4, timeout=30, refresh_margin=600, refresh_interval=60):
+        self.max_requests_per_host = max_requests_per_host
+        self.timeout = timeout
+        self.refresh_margin = refresh_margin
+        self.refresh_interval = refresh_interval
+        self.hosts = {}
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.refresher = None
+
+    def get_session(self, host, api_key, secret_key):
+        key = (host.rstrip('/'), api_key, secret_key)
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None:
+                connections = self.hosts.get(key[0])
+                if connections is None:
+                    connections = self.hosts[key[0]] = HostConnections(key[0], self.max_requests_per_host,
+                                                                       self.timeout)
+                session = self.sessions[key] = PooledSession(self, connections, api_key, secret_key)
+            session.users += 1
+            if self.refresher is None:
+                self.refresher = threading.Thread(target=self._refresh_tokens, name='token-refresh', daemon=True)
+                self.refresher.start()
+        return session
+
+    def release_session(self, session):
+        # Unused sessions and their host's connections are dropped so that the
+        # pool does not outlive the users it serves
+        with self.lock:
+            session.users -= 1
+            if session.users > 0:
+                return
+            host = session.connections.host
+            self.sessions.pop((host, session.api_key, session.secret_key), None)
+            if any(other.connections is session.connections for other in self.sessions.values()):
+                return
+            self.hosts.pop(host, None)
+        session.connections.http.close()
+
+    def _refresh_tokens(self):
+        # Renews tokens of sessions used since their last login before they
+        # expire, so that polls never wait for a login
+        while True:
+            time.sleep(self.refresh_interval)
+            with self.lock:
+                sessions = list(self.sessions.values())
+            for session in sessions:
+                expiring = session.expires_at - time.time() < self.refresh_margin + self.refresh_interval
+                if session.token is not None and expiring and session.last_used > session.logged_in_at:
+                    try:
+                        session.get_token(refresh=True)
+                    except Exception as e:
+                        logging.warning(f'Refreshing the token for {session.connections.host} failed: {e}')
@@ -0,0 +1,287 @@
+import atexit
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+
+import telebot
+
+from instrumentation import start_metrics_server
+from webhook import ChatDispatcher, _get_chat_id, start_webhook_server
+
+
+class HashRing:
+    # Consistent hashing: adding or removing a worker only moves the chats of
+    # the ring segments it gains or loses
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self.nodes = set()
+        self.hashes = []
+        self.owners = []
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.blake2b(str(key).encode(), digest_size=8).digest(), 'big')
+
+    def add(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for replica in range(self.replicas):
+            point = self._hash(f'{node}:{replica}')
+            position = bisect.bisect(self.hashes, point)
+            self.hashes.insert(position, point)
+            self.owners.insert(position, node)
+
+    def remove(self, node):
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        kept = [(point, owner) for point, owner in zip(self.hashes, self.owners) if owner != node]
+        self.hashes = [point for point, _ in kept]
+        self.owners = [owner for _, owner in kept]
+
+    def node_for(self, key):
+        if not self.hashes:
+            return None
+        position = bisect.bisect(self.hashes, self._hash(key)) % len(self.hashes)
+        return self.owners[position]
+
+
+def run_worker(index, config, db_name, inbox, outbox):
+    from bot import ClearMLBot
+    from database import Database
+    from main import run_update_loop
+
+    config = dict(config, SHARD_INDEX=index)
+    database = Database(db_name)
+    bot = ClearMLBot(config["TG_TOKEN"], database, config)
+    dispatcher = ChatDispatcher(lambda update: bot.bot.process_new_updates([update]),
+                                config.get("HANDLER_WORKERS", 8))
+    if config.get("METRICS_PORT"):
+        start_metrics_server(config["METRICS_PORT"] + 1 + index, config.get("METRICS_HOST", "127.0.0.1"))
+
+    def stop_worker(*_):
+        # Render processes are stopped with the worker; update and delivery
+        # threads may be stuck in requests, so they are not waited for
+        bot.renderer.shutdown(wait=True)
+        os._exit(0)
+
+    def watch_front():
+        # A worker whose front process died would keep polling and sending
+        # with nobody routing its chats or restarting it
+        multiprocessing.parent_process().join()
+        logging.error(f'Front process is gone, stopping shard worker {index}')
+        stop_worker()
+
+    signal.signal(signal.SIGTERM, stop_worker)
+    threading.Thread(target=watch_front, name='front-watch', daemon=True).start()
+
+    def handle_inbox():
+        while True:
+            kind, payload = inbox.get()
+            if kind == 'update':
+                dispatcher.submit(_get_chat_id(payload), payload)
+                continue
+
+            nodes, generation = payload
+            ring = HashRing(nodes, config.get("SHARD_REPLICAS", 64))
+            if kind == 'release':
+                # Message state of the chats handed over is flushed before the
+                # front lets their new owners load it
+                for chat_id in list(bot.user_sessions):
+                    if ring.node_for(chat_id) != index:
+                        bot.release_user(chat_id)
+                database.flush_experiments()
+                outbox.put(('released', index, generation))
+            elif kind == 'adopt':
+                adopted = bot.restore_subscriptions(lambda chat_id: ring.node_for(chat_id) == index)
+                database.reload_experiments(adopted)
+                logging.info(f'Shard {index} owns {len(bot.user_sessions)} chats')
+
+    threading.Thread(target=handle_inbox, name='shard-inbox', daemon=True).start()
+    run_update_loop(bot, config)
+
+
+class ShardManager:
+    def __init__(self, config, db_name='database/clearml.db', workers=2, restart_delay=5, rebalance_timeout=60):
+        self.config = config
+        self.db_name = db_name
+        self.worker_count = workers
+        self.restart_delay = restart_delay
+        self.rebalance_timeout = rebalance_timeout
+        self.context = multiprocessing.get_context('spawn')
+        self.outbox = self.context.Queue()
+
+        self.ring = HashRing(replicas=config.get("SHARD_REPLICAS", 64))
+        self.processes = {}
+        self.inboxes = {}
+        self.restart_at = {}
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.rebalance_lock = threading.Lock()
+        self.running = False
+
+    def start(self):
+        self.running = True
+        for index in range(self.worker_count):
+            self._start_worker(index)
+        self.rebalance()
+        threading.Thread(target=self._monitor, name='shard-monitor', daemon=True).start()
+        atexit.register(self.stop)
+        return self
+
+    def _start_worker(self, index):
+        inbox = self.context.Queue()
+        # Workers are not daemonic because each one runs its own rendering pool
+        process = self.context.Process(target=run_worker, name=f'shard-{index}',
+                                       args=(index, self.config, self.db_name, inbox, self.outbox))
+        process.start()
+        with self.lock:
+            self.processes[index] = process
+            self.inboxes[index] = inbox
+            self.ring.add(index)
+        logging.info(f'Started shard worker {index} (pid {process.pid})')
+
+    def route(self, update):
+        chat_id = _get_chat_id(update)
+        with self.lock:
+            index = self.ring.node_for(chat_id)
+            inbox = self.inboxes.get(index)
+        if inbox is None:
+            logging.warning(f'No shard worker for chat {chat_id}, dropping update')
+            return
+        inbox.put(('update', update))
+
+    def rebalance(self):
+        # Two phases so that a chat is never polled by two workers and its new
+        # owner reads the message state its old owner flushed
+        with self.rebalance_lock:
+            with self.lock:
+                self.generation += 1
+                generation = self.generation
+                nodes = sorted(self.ring.nodes)
+                inboxes = dict(self.inboxes)
+
+            for inbox in inboxes.values():
+                inbox.put(('release', (nodes, generation)))
+            waiting = set(inboxes)
+            deadline = time.monotonic() + self.rebalance_timeout
+            while waiting and time.monotonic() < deadline:
+                try:
+                    _, index, acked_generation = self.outbox.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if acked_generation == generation:
+                    waiting.discard(index)
+            if waiting:
+                logging.warning(f'Shard workers {sorted(waiting)} did not release their chats in time')
+
+            for inbox in inboxes.values():
+                inbox.put(('adopt', (nodes, generation)))
+            logging.info(f'Rebalanced chats across shard workers {nodes}')
+
+    def _monitor(self):
+        while True:
+            time.sleep(1)
+            if not self.running:
+                return
+            changed = False
+            with self.lock:
+                for index, process in list(self.processes.items()):
+                    if not process.is_alive():
+                        logging.error(f'Shard worker {index} exited with code {process.exitcode}, '
+                                      f'restarting in {self.restart_delay}s')
+                        self.processes.pop(index)
+                        self.inboxes.pop(index)
+                        self.ring.remove(index)
+                        self.restart_at[index] = time.monotonic() + self.restart_delay
+                        changed = True
+                restarts = [index for index, restart_at in self.restart_at.items()
+                            if restart_at <= time.monotonic()]
+            if changed:
+                self.rebalance()
+            if restarts and self.running:
+                for index in restarts:
+                    self.restart_at.pop(index)
+                    self._start_worker(index)
+                self.rebalance()
+
+    def stop(self):
+        self.running = False
+        with self.lock:
+            processes = list(self.processes.values())
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.kill()
+
+
+class ShardRouter(telebot.TeleBot):
+    # Receives updates in the front process and hands each one to the worker
+    # owning its chat
+    def __init__(self, token, shards):
+        super().__init__(token, threaded=False)
+        self.shards = shards
+
+    def process_new_updates(self, updates):
+        for update in updates:
+            self.shards.route(update)
+
+
+def run_sharded(config, db_name='database/clearml.db'):
+    from database import Database
+    from lifecycle import LifecycleManager
+
+    if config.get("TELEGRAM_API_URL"):
+        telebot.apihelper.API_URL = config["TELEGRAM_API_URL"].rstrip('/') + '/bot{0}/{1}'
+    # The front process owns maintenance; converting the file happens before
+    # any worker opens it
+    database = Database(db_name)
+    database.enable_incremental_vacuum()
+    shards = ShardManager(config, db_name, workers=config["SHARD_WORKERS"],
+                          restart_delay=config.get("SHARD_RESTART_DELAY", 5)).start()
+    router = ShardRouter(config["TG_TOKEN"], shards)
+
+    if config.get("METRICS_PORT"):
+        start_metrics_server(config["METRICS_PORT"], config.get("METRICS_HOST", "127.0.0.1"))
+
+    if config.get("WEBHOOK_URL"):
+        start_webhook_server(
+            router,
+            config["WEBHOOK_URL"],
+            host=config.get("WEBHOOK_HOST", "0.0.0.0"),
+            port=config.get("WEBHOOK_PORT", 8443),
+            secret_token=config.get("WEBHOOK_SECRET"),
+            max_workers=config.get("HANDLER_WORKERS", 8)
+        )
+    else:
+        def polling():
+            while True:
+                try:
+                    router.polling()
+                except Exception as e:
+                    print(f'An error occured in bot.polling: {e}')
+
+        threading.Thread(target=polling, daemon=True).start()
+
+    # Workers only drop idle clients; compaction, expiry and vacuum run here once
+    lifecycle = LifecycleManager(
+        database,
+        {},
+        metrics_ttl=config.get("METRICS_TTL_DAYS", 7) * 24 * 3600,
+        archive_ttl=config.get("ARCHIVE_TTL_DAYS", 90) * 24 * 3600,
+        idle_client_ttl=config.get("IDLE_CLIENT_TTL", 3600)
+    )
+    while True:
+        time.sleep(config.get("LIFECYCLE_INTERVAL", 3600))
+        lifecycle.run()
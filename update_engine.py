@@ -0,0 +1,139 @@
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from instrumentation import dump_slow_cycle, stats
+
+
+class UpdateEngine:
+    def __init__(self, update_user, max_workers=8, user_timeout=30, on_cycle_start=None,
+                 slow_cycle_threshold=None, trace_dir='database/traces'):
+        self.update_user = update_user
+        self.on_cycle_start = on_cycle_start
+        self.slow_cycle_threshold = slow_cycle_threshold
+        self.trace_dir = trace_dir
+        self.user_timeout = user_timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='update')
+
+        self.cycle_lock = threading.Lock()
+        # A cycle still running when the next one is due counts as one overrun,
+        # however many times the loop finds it busy
+        self.cycle_number = 0
+        self.overrun_cycle = None
+
+        # chat_id -> host for jobs that are still running, including the ones
+        # abandoned by a previous cycle because they exceeded their time budget
+        self.in_flight = {}
+        self.started_at = {}
+        self.overdue = set()
+        self.state_lock = threading.Lock()
+
+    def run_cycle(self, users):
+        if not self.cycle_lock.acquire(blocking=False):
+            self.record_overrun()
+            return False
+
+        try:
+            self.cycle_number += 1
+            # users may be a callable so that due users are only taken once the cycle can run
+            if callable(users):
+                users = users()
+            if not users:
+                return True
+            if self.on_cycle_start is not None:
+                self.on_cycle_start()
+            self._run_cycle(users)
+        finally:
+            self.cycle_lock.release()
+        return True
+
+    def is_running(self):
+        return self.cycle_lock.locked()
+
+    def record_overrun(self):
+        cycle_number = self.cycle_number
+        if self.overrun_cycle == cycle_number:
+            return
+        self.overrun_cycle = cycle_number
+        stats.increment("clearml_bot_cycles_skipped_total")
+        logging.warning('Update cycle skipped, previous cycle is still running')
+
+    def _run_cycle(self, users):
+        cycle_start = time.monotonic()
+        if self.slow_cycle_threshold is not None:
+            stats.start_trace()
+        futures = {}
+        hosts = dict(users)
+        for chat_id, host in users:
+            if not self._reserve(chat_id, host):
+                continue
+            futures[self.executor.submit(self._run_user, chat_id, host)] = chat_id
+
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.cancelled():
+                    continue
+                error = future.exception()
+                if error is not None:
+                    stats.increment("clearml_bot_user_update_errors_total", host=hosts[futures[future]])
+                    logging.error(f'Update for user {futures[future]} failed: {error}')
+
+            now = time.monotonic()
+            for future in list(pending):
+                chat_id = futures[future]
+                started = self.started_at.get(chat_id)
+                if started is not None and now - started > self.user_timeout:
+                    logging.warning(f'Update for user {chat_id} exceeded {self.user_timeout}s, '
+                                    f'leaving it to finish in the background')
+                    stats.increment("clearml_bot_user_update_timeouts_total", host=hosts[chat_id])
+                    with self.state_lock:
+                        if chat_id in self.in_flight:
+                            self.overdue.add(chat_id)
+                    pending.discard(future)
+                elif started is None and now - cycle_start > self.user_timeout and future.cancel():
+                    logging.warning(f'Update for user {chat_id} did not start within '
+                                    f'{self.user_timeout}s, postponed to the next cycle')
+                    self._release(chat_id)
+                    pending.discard(future)
+
+        cycle_duration = time.monotonic() - cycle_start
+        stats.observe("clearml_bot_cycle_seconds", cycle_duration)
+        stats.increment("clearml_bot_cycles_total")
+        logging.info(f'Update cycle for {len(futures)} users took {cycle_duration:.2f}s')
+
+        if self.slow_cycle_threshold is not None:
+            spans = stats.finish_trace()
+            if cycle_duration > self.slow_cycle_threshold:
+                dump_slow_cycle(self.trace_dir, cycle_duration, spans)
+
+    def _reserve(self, chat_id, host):
+        with self.state_lock:
+            if chat_id in self.in_flight:
+                return False
+            # A host with an overdue job is treated as slow or dead: its other
+            # users wait until that job returns instead of tying up more workers
+            if any(self.in_flight[overdue_id] == host for overdue_id in self.overdue):
+                logging.warning(f'Skipping update for user {chat_id}: host {host} is not responding')
+                return False
+            self.in_flight[chat_id] = host
+            return True
+
+    def _release(self, chat_id):
+        with self.state_lock:
+            self.in_flight.pop(chat_id, None)
+            self.started_at.pop(chat_id, None)
+            self.overdue.discard(chat_id)
+
+    def _run_user(self, chat_id, host):
+        self.started_at[chat_id] = time.monotonic()
+        try:
+            with stats.timed("user_update", host=host, user=chat_id):
+                self.update_user(chat_id)
+        finally:
+            self._release(chat_id)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)